@@ -0,0 +1,68 @@
+from dagster import asset, AssetSelection, MonthlyPartitionsDefinition, Output, define_asset_job
+import pandas as pd
+from main import store_crash_events, store_crash_victims
+from instrument import instrumented_op
+from transform import (transform_traffic_crash_events_data, transform_crash_victims_data, join, load_partition,
+                       refresh_aggregates, extract_start_date, logger)
+
+# One partition per calendar month of crash_date, matching the monthly partitions of the crashes and people tables
+monthly_partitions = MonthlyPartitionsDefinition(start_date=extract_start_date.strftime('%Y-%m-%d'))
+
+def partition_window(context):
+    # Naive [start, end) datetimes of the partition being materialized, as stored in MongoDB and PostgreSQL
+    window = context.partition_time_window
+    return window.start.replace(tzinfo=None), window.end.replace(tzinfo=None)
+
+@asset(required_resource_keys={"mongo"})
+@instrumented_op
+def raw_traffic_crash_events(context):
+    # The ingest is incremental on its own, so the raw collections are not partitioned
+    result, totals = store_crash_events(context.resources.mongo)
+    return Output(result, metadata=totals)
+
+@asset(required_resource_keys={"mongo"})
+@instrumented_op
+def raw_crash_victims(context):
+    result, totals = store_crash_victims(context.resources.mongo)
+    return Output(result, metadata=totals)
+
+@asset(partitions_def=monthly_partitions, required_resource_keys={"mongo"}, deps=[raw_traffic_crash_events])
+@instrumented_op
+def cleaned_crash_events(context) -> pd.DataFrame:
+    # Only the crashes of the partition month are read and transformed
+    start, end = partition_window(context)
+    return transform_traffic_crash_events_data(context.resources.mongo, start, end)
+
+@asset(partitions_def=monthly_partitions, required_resource_keys={"mongo"}, deps=[raw_crash_victims])
+@instrumented_op
+def cleaned_crash_victims(context) -> pd.DataFrame:
+    start, end = partition_window(context)
+    return transform_crash_victims_data(context.resources.mongo, start, end)
+
+@asset(partitions_def=monthly_partitions, required_resource_keys={"postgres"})
+@instrumented_op
+def crash_facts(context, cleaned_crash_events: pd.DataFrame, cleaned_crash_victims: pd.DataFrame):
+    # Victims share the crash_date of their crash, so the join never crosses a month boundary
+    start, end = partition_window(context)
+    merged_df = join(cleaned_crash_events, cleaned_crash_victims)
+    crash_count, people_count = load_partition(merged_df, context.resources.postgres, start, end)
+    return Output(crash_count > 0, metadata={"crashes": crash_count, "people": people_count})
+
+@asset(required_resource_keys={"postgres"}, deps=[crash_facts])
+@instrumented_op
+def crash_aggregates(context):
+    # Every crash_facts partition already rebuilds the summary tables; this asset rebuilds them on demand,
+    # e.g. after changing the geo grid size
+    refresh_aggregates(context.resources.postgres)
+    logger.info("Summary tables rebuilt from the crashes and people tables.")
+    return True
+
+# Backfills and the monthly refresh run this job for the partitions that changed
+monthly_crash_facts_job = define_asset_job(
+    "monthly_crash_facts_job",
+    selection=AssetSelection.assets(cleaned_crash_events, cleaned_crash_victims, crash_facts),
+    partitions_def=monthly_partitions
+)
+
+crash_assets = [raw_traffic_crash_events, raw_crash_victims, cleaned_crash_events, cleaned_crash_victims,
+                crash_facts, crash_aggregates]
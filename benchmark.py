@@ -0,0 +1,214 @@
+import os
+import csv
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from dagster import build_op_context
+from main import CRASH_EVENTS_COLUMNS, CSV_DATE_FORMAT, store_crash_events, store_crash_victims
+from transform import (transform_traffic_crash_events_data, transform_crash_victims_data, join, load,
+                       extract_start_date)
+from vis import (visualize_time_of_day_impact, visualize_age_gender_impact, visualize_safety_measures_effectiveness,
+                 visualize_environmental_impact, visualize_crash_causes, visualize_cell_phone_impact,
+                 visualize_geographic_patterns)
+from resources import get_engine
+
+# Columns of the people CSV, in the order of the Chicago export
+PEOPLE_COLUMNS = ['PERSON_ID', 'PERSON_TYPE', 'CRASH_RECORD_ID', 'VEHICLE_ID', 'CRASH_DATE', 'SEAT_NO', 'CITY', 'STATE',
+                  'ZIPCODE', 'SEX', 'AGE', 'DRIVERS_LICENSE_STATE', 'DRIVERS_LICENSE_CLASS', 'SAFETY_EQUIPMENT',
+                  'AIRBAG_DEPLOYED', 'EJECTION', 'INJURY_CLASSIFICATION', 'HOSPITAL', 'EMS_AGENCY', 'EMS_RUN_NO',
+                  'DRIVER_ACTION', 'DRIVER_VISION', 'PHYSICAL_CONDITION', 'PEDPEDAL_ACTION', 'PEDPEDAL_VISIBILITY',
+                  'PEDPEDAL_LOCATION', 'BAC_RESULT', 'BAC_RESULT VALUE', 'CELL_PHONE_USE']
+
+# Value pools of the generated columns, roughly following the categories of the real data
+WEATHER = ['CLEAR', 'CLEAR', 'CLEAR', 'RAIN', 'SNOW', 'CLOUDY/OVERCAST', 'FOG/SMOKE/HAZE', 'UNKNOWN']
+LIGHTING = ['DAYLIGHT', 'DAYLIGHT', 'DARKNESS, LIGHTED ROAD', 'DARKNESS', 'DUSK', 'DAWN', 'UNKNOWN']
+CAUSES = ['UNABLE TO DETERMINE', 'FAILING TO YIELD RIGHT-OF-WAY', 'FOLLOWING TOO CLOSELY', 'IMPROPER OVERTAKING/PASSING',
+          'FAILING TO REDUCE SPEED TO AVOID CRASH', 'DISREGARDING TRAFFIC SIGNALS', 'IMPROPER BACKING']
+SEXES = ['M', 'F', 'X']
+INJURIES = ['NO INDICATION OF INJURY', 'NO INDICATION OF INJURY', 'NONINCAPACITATING INJURY', 'REPORTED, NOT EVIDENT',
+            'INCAPACITATING INJURY', 'FATAL']
+SAFETY_EQUIPMENT = ['SAFETY BELT USED', 'USAGE UNKNOWN', 'NONE PRESENT', 'HELMET NOT USED', 'CHILD RESTRAINT USED']
+AIRBAGS = ['DID NOT DEPLOY', 'DEPLOYMENT UNKNOWN', 'NOT APPLICABLE', 'DEPLOYED, FRONT', 'DEPLOYED, COMBINATION']
+DRIVER_ACTIONS = ['NONE', 'UNKNOWN', 'FAILED TO YIELD', 'FOLLOWED TOO CLOSELY', 'IMPROPER BACKING', 'OTHER']
+PHYSICAL_CONDITIONS = ['NORMAL', 'NORMAL', 'UNKNOWN', 'IMPAIRED - ALCOHOL', 'FATIGUED/ASLEEP']
+CELL_PHONE_USE = ['', '', '', 'Y', 'N']
+
+def generate_dataset(directory, rows, seed, start=extract_start_date, days=365):
+    # Write a crash events JSON in the {"data": [[...]]} layout of the export and a people CSV with
+    # one to four people per crash; both files are streamed, so 10M rows need no more memory than 10k
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    json_path = os.path.join(directory, "crash_events-{}-{}.json".format(rows, seed))
+    csv_path = os.path.join(directory, "crash_victims-{}-{}.csv".format(rows, seed))
+    people = 0
+
+    with open(json_path, 'w') as json_file, open(csv_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(PEOPLE_COLUMNS)
+        json_file.write('{"data": [')
+        for row in range(rows):
+            crash_record_id = "{:0128x}".format(rng.getrandbits(512))
+            crash_date = start + timedelta(seconds=rng.randrange(days * 86400))
+            latitude, longitude = round(rng.uniform(41.65, 42.02), 6), round(rng.uniform(-87.93, -87.52), 6)
+            values = {
+                'row_id': "row-{}".format(row), 'guid': hashlib.md5(crash_record_id.encode()).hexdigest(),
+                'created_at': int(crash_date.timestamp()), 'updated_at': int(crash_date.timestamp()) + rng.randrange(86400),
+                'crash_record_id': crash_record_id, 'crash_date': crash_date.strftime('%Y-%m-%dT%H:%M:%S.000'),
+                'date_police_notified': (crash_date + timedelta(minutes=rng.randrange(240))).strftime('%Y-%m-%dT%H:%M:%S.000'),
+                'posted_speed_limit': str(rng.choice([20, 25, 30, 35, 45])), 'weather_condition': rng.choice(WEATHER),
+                'lighting_condition': rng.choice(LIGHTING), 'lane_cnt': str(rng.randint(1, 4)),
+                'prim_contributory_cause': rng.choice(CAUSES), 'sec_contributory_cause': rng.choice(CAUSES),
+                'street_no': str(rng.randrange(1, 13000)), 'street_name': 'STREET {}'.format(rng.randrange(500)),
+                'beat_of_occurrence': str(rng.randrange(111, 2536)), 'num_units': str(rng.randint(1, 4)),
+                'injuries_total': str(rng.randint(0, 3)), 'injuries_fatal': '0',
+                'crash_hour': str(crash_date.hour), 'crash_day_of_week': str(crash_date.isoweekday() % 7 + 1),
+                'crash_month': str(crash_date.month), 'latitude': str(latitude), 'longitude': str(longitude),
+                'location': "POINT ({} {})".format(longitude, latitude)
+            }
+            if row:
+                json_file.write(',')
+            json_file.write(json.dumps([values.get(column) for column in CRASH_EVENTS_COLUMNS]))
+
+            csv_date = crash_date.strftime(CSV_DATE_FORMAT)
+            for person in range(rng.randint(1, 4)):
+                people += 1
+                writer.writerow([
+                    "P{}".format(people), 'DRIVER' if person == 0 else 'PASSENGER', crash_record_id, str(row),
+                    csv_date, '' if person == 0 else str(person + 1), 'CHICAGO', 'IL', '', rng.choice(SEXES),
+                    str(rng.randint(16, 90)), 'IL', 'D', rng.choice(SAFETY_EQUIPMENT), rng.choice(AIRBAGS), 'NONE',
+                    rng.choice(INJURIES), '', '', '', rng.choice(DRIVER_ACTIONS), 'NOT OBSCURED',
+                    rng.choice(PHYSICAL_CONDITIONS), '', '', '', 'TEST NOT OFFERED', '', rng.choice(CELL_PHONE_USE)
+                ])
+        json_file.write(']}')
+    return json_path, csv_path, people
+
+class BenchmarkRun:
+    # Collects the wall time and row count of every stage of one run
+    def __init__(self, **settings):
+        self.results = {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'settings': settings,
+            'stages': {}
+        }
+
+    @contextmanager
+    def stage(self, name):
+        # The body can set 'rows' on the yielded dict
+        stage = {}
+        started = time.perf_counter()
+        yield stage
+        stage['seconds'] = round(time.perf_counter() - started, 4)
+        if stage.get('rows'):
+            stage['rows_per_second'] = round(stage['rows'] / max(stage['seconds'], 1e-9), 1)
+        self.results['stages'][name] = stage
+        print("{:<45} {:>10.3f}s  {}".format(name, stage['seconds'], stage.get('rows', '')))
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(self.results, file, indent=2)
+
+def compare(results, baseline_path):
+    # Print the time of every stage relative to a previous results file
+    with open(baseline_path) as file:
+        baseline = json.load(file)['stages']
+    for name, stage in results['stages'].items():
+        if name in baseline and baseline[name]['seconds'] > 0:
+            print("{:<45} {:>8.2f}x".format(name, stage['seconds'] / baseline[name]['seconds']))
+
+# Scratch database of the benchmark, dropped before every run; the pipeline's TrafficIncidentsDB is never touched
+BENCHMARK_DATABASE = "TrafficIncidentsBenchmark"
+
+def connect_mongo(args):
+    if args.mongomock:
+        # In-process stand-in, optional and only needed for this mode
+        import mongomock
+        return mongomock.MongoClient()
+    from pymongo import MongoClient
+    return MongoClient(args.mongo_uri)
+
+def run(args):
+    benchmark = BenchmarkRun(rows=args.rows, seed=args.seed, mongomock=args.mongomock)
+
+    with benchmark.stage('generate') as stage:
+        json_path, csv_path, people = generate_dataset(args.data_dir, args.rows, args.seed)
+        stage['rows'] = args.rows + people
+
+    client = connect_mongo(args)
+    # Every run starts from an empty scratch database, so the ingest is not reduced to a no-op by the watermarks
+    client.drop_database(BENCHMARK_DATABASE)
+    with benchmark.stage('ingest_crash_events') as stage:
+        _, totals = store_crash_events(client, json_path, database=BENCHMARK_DATABASE)
+        stage['rows'] = totals.get('inserted', 0) + totals.get('upserted', 0)
+    with benchmark.stage('ingest_crash_victims') as stage:
+        _, totals = store_crash_victims(client, csv_path, database=BENCHMARK_DATABASE)
+        stage['rows'] = totals.get('inserted', 0) + totals.get('upserted', 0)
+
+    # The transforms run in this process: the partition workers of extract_in_partitions connect to the
+    # configured server instead of the benchmark one
+    with benchmark.stage('extract_transform_crash_events') as stage:
+        crash_events_df = transform_traffic_crash_events_data(client, database=BENCHMARK_DATABASE)
+        stage['rows'] = len(crash_events_df)
+    with benchmark.stage('extract_transform_crash_victims') as stage:
+        crash_victims_df = transform_crash_victims_data(client, database=BENCHMARK_DATABASE)
+        stage['rows'] = len(crash_victims_df)
+    with benchmark.stage('join') as stage:
+        merged_df = join(crash_events_df, crash_victims_df)
+        stage['rows'] = len(merged_df)
+
+    postgres = None
+    postgres_uri = args.postgres_uri
+    if args.temp_postgres:
+        # Throwaway server in a temporary directory, optional and only needed for this mode
+        import testing.postgresql
+        postgres = testing.postgresql.Postgresql()
+        postgres_uri = postgres.url()
+    try:
+        if postgres_uri:
+            engine = get_engine(postgres_uri)
+            with benchmark.stage('load') as stage:
+                # A failed load is an error of the run, not a timed stage
+                if not load(merged_df, engine):
+                    raise RuntimeError("The load into {} failed, see the log above".format(engine.url.database))
+                stage['rows'] = len(merged_df)
+            context = build_op_context(resources={"postgres": engine})
+            for vis_op in [visualize_time_of_day_impact, visualize_age_gender_impact,
+                           visualize_safety_measures_effectiveness, visualize_environmental_impact,
+                           visualize_crash_causes, visualize_cell_phone_impact, visualize_geographic_patterns]:
+                with benchmark.stage(vis_op.name):
+                    vis_op(context, True)
+        else:
+            print("No PostgreSQL given, skipping the load and the visualizations")
+    finally:
+        if postgres is not None:
+            postgres.stop()
+
+    output = args.output or os.path.join("benchmark", "results-{}-{:%Y%m%dT%H%M%S}.json".format(args.rows, datetime.now()))
+    benchmark.write(output)
+    print("Results written to {}".format(output))
+    if args.compare:
+        compare(benchmark.results, args.compare)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time every stage of the pipeline on seeded synthetic crash data. "
+                                                 "The data goes to the {} database of the MongoDB server, which is "
+                                                 "dropped before every run.".format(BENCHMARK_DATABASE))
+    parser.add_argument('--rows', type=int, default=10000, help="number of crashes, e.g. 10000 up to 10000000")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--data-dir', default=os.path.join("benchmark", "data"))
+    # The MongoDB server is always chosen explicitly
+    mongo = parser.add_mutually_exclusive_group(required=True)
+    mongo.add_argument('--mongo-uri', help="MongoDB server of the scratch database")
+    mongo.add_argument('--mongomock', action='store_true', help="use an in-process mongomock client")
+    parser.add_argument('--postgres-uri', help="SQLAlchemy URL of a scratch PostgreSQL database")
+    parser.add_argument('--temp-postgres', action='store_true', help="start a throwaway server with testing.postgresql")
+    parser.add_argument('--output', help="results JSON, by default benchmark/results-<rows>-<time>.json")
+    parser.add_argument('--compare', help="previous results JSON to compare the stage times with")
+    run(parser.parse_args())
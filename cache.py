@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pandas as pd
+import yaml
+from sqlalchemy import text
+from dagster import get_dagster_logger
+
+logger = get_dagster_logger()
+
+def load_config():
+    with open('config.yaml', 'r') as file:
+        return yaml.safe_load(file)
+
+config = load_config()
+# Local Parquet cache of the transformed frames, evicted by total size and age
+cache_config = config['cache']
+
+def cache_key(*parts):
+    # Stable hash of the JSON representation of the given parts
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:24]
+
+def code_version(*objects):
+    # Hash of the source code of functions and the repr of constants, so editing a transform invalidates its entries
+    parts = [inspect.getsource(obj) if callable(obj) else repr(obj) for obj in objects]
+    return cache_key(*parts)
+
+class CacheEntryMissing(LookupError):
+    # The entry was never written or has been evicted, by age or by the LRU eviction of another run
+    pass
+
+class FrameCache:
+    # Every entry is a directory <name>-<key> holding one Parquet file per frame, written to a temporary
+    # directory first and renamed into place, so a crashed run never leaves a half written entry behind
+    def __init__(self, directory=None, max_bytes=None, max_age_days=None):
+        self.directory = directory or cache_config['directory']
+        self.max_bytes = max_bytes if max_bytes is not None else cache_config['max_bytes']
+        self.max_age = (max_age_days if max_age_days is not None else cache_config['max_age_days']) * 86400
+
+    def path(self, name, key):
+        return os.path.join(self.directory, "{}-{}".format(name, key))
+
+    def get(self, name, key):
+        # Return the Parquet files of an entry, or None when it is missing
+        path = self.path(name, key)
+        if not os.path.isdir(path):
+            return None
+        # Mark the entry as recently used for the eviction
+        os.utime(path)
+        return [os.path.join(path, file_name) for file_name in sorted(os.listdir(path))]
+
+    def read(self, name, key):
+        # Return a generator of the frames of an entry, read one at a time; the files are memory mapped instead of
+        # copied into buffers. A missing entry raises right away instead of reading as an entry without frames
+        file_paths = self.get(name, key)
+        if file_paths is None:
+            raise CacheEntryMissing("Cache entry {}-{} is missing".format(name, key))
+        return (pq.read_table(file_path, memory_map=True).to_pandas() for file_path in file_paths)
+
+    def put(self, name, key, frames, keep=()):
+        # Store the frames of an iterable under name and key and return how many were written; the new entry
+        # and the (name, key) entries in keep are never evicted by this write
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(name, key)
+        temp_path = "{}.tmp-{}".format(path, os.getpid())
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        count = 0
+        for frame in frames:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            pq.write_table(table, os.path.join(temp_path, "part-{:05d}.parquet".format(count)))
+            count += 1
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temp_path, path)
+        self.evict(keep=[path] + [self.path(*entry) for entry in keep])
+        return count
+
+    def evict(self, keep=()):
+        # Drop entries older than max_age, then the least recently used ones until the cache fits max_bytes
+        if not os.path.isdir(self.directory):
+            return
+        now = time.time()
+        entries = []
+        for entry_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, entry_name)
+            if not os.path.isdir(path) or '.tmp-' in entry_name:
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except FileNotFoundError:
+                # Evicted or replaced by another process meanwhile
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if path in keep:
+                continue
+            if now - mtime > self.max_age or total > self.max_bytes:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                logger.info("Evicted cache entry {} ({:.1f} MB)".format(os.path.basename(path), size / 1e6))
+
+frame_cache = FrameCache()
+
+# Chart query cache: results are keyed by the SQL text, its parameters and the load generation
+query_cache_config = config['query_cache']
+LOAD_GENERATION_FILE = 'load_generation'
+
+def get_load_generation():
+    # Generation of the data in PostgreSQL, bumped after every successful load
+    try:
+        with open(os.path.join(query_cache_config['directory'], LOAD_GENERATION_FILE)) as file:
+            return int(file.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def bump_load_generation():
+    # Invalidates every cached chart query; written to a temporary file first so readers never see a partial value
+    generation = get_load_generation() + 1
+    os.makedirs(query_cache_config['directory'], exist_ok=True)
+    path = os.path.join(query_cache_config['directory'], LOAD_GENERATION_FILE)
+    temp_path = "{}.tmp-{}".format(path, os.getpid())
+    with open(temp_path, 'w') as file:
+        file.write(str(generation))
+    os.replace(temp_path, path)
+    return generation
+
+class QueryCache:
+    # Two tiers: an in-memory LRU of data frames per process and Parquet files shared by every process on the machine.
+    # With ttl_seconds set, entries also expire within a generation, in case PostgreSQL was loaded from another machine
+    def __init__(self, directory=None, memory_entries=None, max_bytes=None, ttl_seconds=None):
+        self.directory = directory or query_cache_config['directory']
+        self.enabled = query_cache_config['enabled']
+        self.memory_entries = memory_entries if memory_entries is not None else query_cache_config['memory_entries']
+        self.max_bytes = max_bytes if max_bytes is not None else query_cache_config['max_bytes']
+        self.ttl = ttl_seconds if ttl_seconds is not None else query_cache_config['ttl_seconds']
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def key(self, *parts):
+        return cache_key(*parts, get_load_generation())
+
+    def expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key):
+        # Return a copy of the cached frame, callers are free to modify it
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and not self.expired(entry[0]):
+                self.memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return entry[1].copy()
+        path = os.path.join(self.directory, key + '.parquet')
+        try:
+            created = os.path.getmtime(path)
+            if not self.expired(created):
+                df = pq.read_table(path, memory_map=True).to_pandas()
+                self.remember(key, df, created)
+                with self.lock:
+                    self.counters['disk_hits'] += 1
+                return df.copy()
+        except FileNotFoundError:
+            # Never written, or evicted by another process between the stat and the read
+            pass
+        with self.lock:
+            self.counters['misses'] += 1
+        return None
+
+    def remember(self, key, df, created=None):
+        with self.lock:
+            self.memory[key] = (created or time.time(), df)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+
+    def put(self, key, df):
+        self.remember(key, df)
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, key + '.parquet')
+        temp_path = "{}.tmp-{}".format(path, os.getpid())
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), temp_path)
+        os.replace(temp_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        # Drop expired files, then the oldest ones until the directory fits max_bytes; keep is never dropped
+        files = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.parquet'):
+                path = os.path.join(self.directory, file_name)
+                try:
+                    files.append((os.path.getmtime(path), os.path.getsize(path), path))
+                except FileNotFoundError:
+                    # Evicted by another process meanwhile
+                    continue
+        total = sum(size for _, size, _ in files)
+        for mtime, size, path in sorted(files):
+            if path == keep:
+                continue
+            if self.expired(mtime) or total > self.max_bytes:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def read(self, engine, sql, params=None):
+        # Run the query only when its result is in neither tier; returns the frame and whether it was a hit
+        key = self.key(str(engine.url), sql, params)
+        df = self.get(key) if self.enabled else None
+        if df is not None:
+            return df, True
+        with engine.connect() as connection:
+            df = pd.read_sql_query(text(sql), connection, params=params)
+        if self.enabled:
+            self.put(key, df)
+        return df.copy(), False
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, memory_entries=len(self.memory), generation=get_load_generation())
+
+query_cache = QueryCache()
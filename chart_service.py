@@ -0,0 +1,205 @@
+import json
+import math
+import logging
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pyarrow as pa
+import yaml
+from resources import get_engine
+from cache import query_cache
+from transform import CRASH_ROWS_SELECT, PERSON_ROWS_SELECT, LOCATED_CRASHES, geo_grid_size
+
+# Set up a basic logger
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+def load_config():
+    with open('config.yaml', 'r') as file:
+        return yaml.safe_load(file)
+
+config = load_config()
+service_config = config['chart_service']
+
+# One row per crash and one row per person, both with every filter column; the inlined selects let PostgreSQL
+# push the filters down to the crashes partitions and their indexes
+CRASHES = "({}) t".format(CRASH_ROWS_SELECT.format(crashes="public.crashes"))
+PEOPLE = "({}) t".format(PERSON_ROWS_SELECT.format(crashes="public.crashes", people="public.people"))
+
+# The seven research queries, crash level ones count crashes and person level ones people;
+# {where} receives the filters of the request and :grid the cell size of the map
+ENDPOINTS = {
+    'time_of_day': """
+        SELECT COALESCE(crash_hour, -1) AS crash_hour, COUNT(*) AS num_crashes
+        FROM {crashes} WHERE {where}
+        GROUP BY 1 ORDER BY 1
+    """,
+    'age_gender': """
+        SELECT "AGE", "SEX", "INJURY_CLASSIFICATION", COUNT(*) AS cases
+        FROM {people} WHERE {where} AND "INJURY_CLASSIFICATION" IS NOT NULL AND "SEX" IN ('M', 'F') AND "AGE" <> -1
+        GROUP BY 1, 2, 3 ORDER BY 1, 2
+    """,
+    'safety_measures': """
+        SELECT "SAFETY_EQUIPMENT", "AIRBAG_DEPLOYED", "INJURY_CLASSIFICATION", COUNT(*) AS cases
+        FROM {people} WHERE {where} AND "INJURY_CLASSIFICATION" IS NOT NULL
+        GROUP BY 1, 2, 3 ORDER BY 1, 2
+    """,
+    'environmental': """
+        SELECT weather_condition, lighting_condition, COUNT(*) AS num_crashes
+        FROM {crashes} WHERE {where}
+        GROUP BY 1, 2 ORDER BY 1, 2
+    """,
+    'crash_causes': """
+        SELECT prim_contributory_cause, "DRIVER_ACTION", "PHYSICAL_CONDITION", COUNT(*) AS num_cases
+        FROM {people} WHERE {where}
+        GROUP BY 1, 2, 3 ORDER BY 1, 2, 3
+    """,
+    'cell_phone': """
+        SELECT COALESCE("CELL_PHONE_USE", 'Unknown') AS "CELL_PHONE_USE", COUNT(*) AS num_cases
+        FROM {people} WHERE {where}
+        GROUP BY 1 ORDER BY 1
+    """,
+    'geographic': """
+        SELECT (FLOOR(latitude / :grid) + 0.5) * :grid AS latitude,
+               (FLOOR(longitude / :grid) + 0.5) * :grid AS longitude,
+               COUNT(*) AS num_crashes
+        FROM {crashes} WHERE {where} AND {located}
+        GROUP BY FLOOR(latitude / :grid), FLOOR(longitude / :grid)
+    """
+}
+
+class ResultTooLarge(Exception):
+    # The result of a request has more than max_rows rows; aggregates are never cut off silently
+    pass
+
+def parse_number(value, name):
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError("{} must be a finite number".format(name))
+    return number
+
+def parse_hour(value, name):
+    hour = int(value)
+    if not 0 <= hour <= 23:
+        raise ValueError("{} must be an hour from 0 to 23".format(name))
+    return hour
+
+def parse_grid(query):
+    # Cell size of the geographic endpoint in degrees
+    grid = parse_number(query.get('grid', [geo_grid_size])[0], 'grid')
+    if grid <= 0:
+        raise ValueError("grid must be a positive number of degrees")
+    return grid
+
+def parse_list(values):
+    # Repeated parameters and comma separated values, e.g. weather=RAIN&weather=SNOW or weather=RAIN,SNOW
+    return [item.strip() for value in values for item in value.split(',') if item.strip()]
+
+def build_filters(query):
+    # Turn the query string into a WHERE clause with bound parameters; raises ValueError on invalid values
+    conditions, params = ["TRUE"], {}
+    if 'start' in query:
+        conditions.append("crash_date >= :start")
+        params['start'] = datetime.fromisoformat(query['start'][0])
+    if 'end' in query:
+        conditions.append("crash_date < :end")
+        params['end'] = datetime.fromisoformat(query['end'][0])
+    if 'hour_from' in query or 'hour_to' in query:
+        conditions.append("crash_hour BETWEEN :hour_from AND :hour_to")
+        params['hour_from'] = parse_hour(query.get('hour_from', ['0'])[0], 'hour_from')
+        params['hour_to'] = parse_hour(query.get('hour_to', ['23'])[0], 'hour_to')
+    for name, column in [('weather', 'weather_condition'), ('lighting', 'lighting_condition')]:
+        if name in query:
+            conditions.append("{} = ANY(:{})".format(column, name))
+            params[name] = parse_list(query[name])
+    if 'bbox' in query:
+        # min_lon,min_lat,max_lon,max_lat
+        values = query['bbox'][0].split(',')
+        if len(values) != 4:
+            raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+        min_lon, min_lat, max_lon, max_lat = (parse_number(value, 'bbox') for value in values)
+        if min_lon > max_lon or min_lat > max_lat:
+            raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+        conditions.append("longitude BETWEEN :min_lon AND :max_lon AND latitude BETWEEN :min_lat AND :max_lat")
+        params.update(min_lon=min_lon, min_lat=min_lat, max_lon=max_lon, max_lat=max_lat)
+    return " AND ".join(conditions), params
+
+def run_query(name, query):
+    where, params = build_filters(query)
+    sql = ENDPOINTS[name].format(crashes=CRASHES, people=PEOPLE, located=LOCATED_CRASHES, where=where)
+    if name == 'geographic':
+        params['grid'] = parse_grid(query)
+    # One row more than allowed tells a complete result from a cut off one
+    max_rows = service_config['max_rows']
+    sql += " LIMIT {:d}".format(max_rows + 1)
+    # Filtered results are cached like the chart queries, until the next load
+    df, _ = query_cache.read(get_engine(), sql, params)
+    if len(df) > max_rows:
+        raise ResultTooLarge("The result has more than {} rows, narrow the filters or use a coarser grid".format(max_rows))
+    return df
+
+class ChartRequestHandler(BaseHTTPRequestHandler):
+    def send_payload(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, payload):
+        self.send_payload(status, json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        name = url.path.strip('/')
+        query = parse_qs(url.query)
+        if name == '':
+            self.send_json(200, {'endpoints': sorted(ENDPOINTS), 'filters': ['start', 'end', 'hour_from', 'hour_to',
+                                                                             'weather', 'lighting', 'bbox', 'grid'],
+                                 'formats': ['json', 'arrow']})
+            return
+        if name == 'stats':
+            self.send_json(200, query_cache.stats())
+            return
+        if name not in ENDPOINTS:
+            self.send_json(404, {'error': "Unknown endpoint: {}".format(name)})
+            return
+
+        try:
+            df = run_query(name, query)
+        except ValueError as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        except ResultTooLarge as error:
+            self.send_json(413, {'error': str(error)})
+            return
+        except Exception as error:
+            logger.error("Query {} failed: {}".format(name, error))
+            self.send_json(500, {'error': 'query failed'})
+            return
+
+        if query.get('format', ['json'])[0] == 'arrow':
+            # Arrow IPC stream, readable with pyarrow.ipc.open_stream or the Arrow JS library
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            self.send_payload(200, sink.getvalue().to_pybytes(), 'application/vnd.apache.arrow.stream')
+        else:
+            # {"columns": [...], "data": [[...], ...]} without the index
+            self.send_payload(200, df.to_json(orient='split', index=False, date_format='iso').encode('utf-8'))
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s", self.address_string(), format % args)
+
+def serve(host=None, port=None):
+    # Every request thread borrows a connection from the shared, pooled engine
+    server = ThreadingHTTPServer((host or service_config['host'], port or service_config['port']), ChartRequestHandler)
+    logger.info("Chart service listening on http://{}:{}/".format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,220 @@
+import os
+import re
+import sys
+import time
+import threading
+import functools
+from contextlib import contextmanager
+import pandas as pd
+import psycopg2.extensions
+import yaml
+from dagster import Output, get_dagster_logger
+from pymongo import monitoring
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where psutil is used for the peak RSS when installed
+    resource = None
+
+logger = get_dagster_logger()
+
+def load_config():
+    with open('config.yaml', 'r') as file:
+        return yaml.safe_load(file)
+
+config = load_config()
+# Directory read by the node_exporter textfile collector, None disables the Prometheus output
+prometheus_dir = config['instrumentation']['prometheus_dir']
+
+# Round trips of this process to MongoDB and PostgreSQL
+_round_trips = {'mongo': 0, 'postgres': 0}
+_round_trips_lock = threading.Lock()
+# Stack of the measurements running in the current thread, so nested stages are reported with their parent
+_active = threading.local()
+
+def count_round_trip(server):
+    with _round_trips_lock:
+        _round_trips[server] += 1
+
+class MongoCommandCounter(monitoring.CommandListener):
+    # Counts every command sent to MongoDB, including the getMore batches of a cursor
+    def started(self, event):
+        count_round_trip('mongo')
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+# Registered at import time, so it applies to every MongoClient created afterwards
+monitoring.register(MongoCommandCounter())
+
+class CountingCursor(psycopg2.extensions.cursor):
+    # Cursor factory of the pooled PostgreSQL connections, counts statements and COPY streams
+    def execute(self, query, vars=None):
+        count_round_trip('postgres')
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        count_round_trip('postgres')
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        count_round_trip('postgres')
+        return super().copy_expert(sql, file, size)
+
+def peak_rss_bytes():
+    # Peak resident set size of the process so far
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS and in kilobytes elsewhere
+        return peak if sys.platform == 'darwin' else peak * 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory = psutil.Process().memory_info()
+    return getattr(memory, 'peak_wset', memory.rss)
+
+def count_rows(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    return None
+
+def count_bytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True).sum())
+    return None
+
+class Measurement:
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes = None
+        self.children = []
+        # Additional numeric values, e.g. cache hits
+        self.extra = {}
+        self.started = time.perf_counter()
+        self.round_trips_start = dict(_round_trips)
+        # The peak RSS is a high-water mark of the whole process, a stage can only be measured by how much it raised it
+        self.peak_rss_start = peak_rss_bytes()
+        self.wall_seconds = None
+        self.round_trips = None
+        self.peak_rss = None
+
+    def finish(self):
+        self.wall_seconds = time.perf_counter() - self.started
+        self.round_trips = {server: _round_trips[server] - self.round_trips_start[server] for server in _round_trips}
+        self.peak_rss = peak_rss_bytes()
+
+    def values(self):
+        values = {
+            'wall_seconds': round(self.wall_seconds, 4),
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'bytes': self.bytes,
+            'process_peak_rss_mb': round(self.peak_rss / 2 ** 20, 1) if self.peak_rss is not None else None,
+            'peak_rss_growth_mb': round((self.peak_rss - self.peak_rss_start) / 2 ** 20, 1)
+                                  if self.peak_rss is not None and self.peak_rss_start is not None else None,
+            'mongo_round_trips': self.round_trips['mongo'],
+            'postgres_round_trips': self.round_trips['postgres']
+        }
+        values.update(self.extra)
+        if self.rows_out:
+            values['rows_per_second'] = round(self.rows_out / max(self.wall_seconds, 1e-9), 1)
+        return {key: value for key, value in values.items() if value is not None}
+
+    def metadata(self, prefix=''):
+        # Flat metadata of the stage and its nested stages, the nested ones prefixed with their name
+        metadata = {prefix + key: value for key, value in self.values().items()}
+        for child in self.children:
+            metadata.update(child.metadata(prefix + child.name + '.'))
+        return metadata
+
+def record(**values):
+    # Set rows_in, rows_out or bytes on the innermost running measurement of this thread, other values
+    # are added to its extra values
+    stack = getattr(_active, 'stack', None)
+    if stack:
+        for key, value in values.items():
+            if key in ('rows_in', 'rows_out', 'bytes'):
+                setattr(stack[-1], key, value)
+            else:
+                stack[-1].extra[key] = value
+
+@contextmanager
+def measure(name, rows_in=None):
+    # Measure wall time, round trips and peak RSS of the block; the block can set rows and bytes on the measurement
+    stack = getattr(_active, 'stack', None)
+    if stack is None:
+        stack = _active.stack = []
+    measurement = Measurement(name, rows_in)
+    parent = stack[-1] if stack else None
+    stack.append(measurement)
+    try:
+        yield measurement
+    finally:
+        stack.pop()
+        measurement.finish()
+        logger.info("{}: {}".format(name, measurement.values()))
+        if parent is not None:
+            parent.children.append(measurement)
+        elif prometheus_dir:
+            write_prometheus(measurement)
+
+def instrumented(function):
+    # Measure every call of a function; data frame arguments count as rows in and a data frame result as rows out
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        frames = [arg for arg in list(args) + list(kwargs.values()) if isinstance(arg, pd.DataFrame)]
+        with measure(function.__name__, sum(len(frame) for frame in frames) if frames else None) as measurement:
+            result = function(*args, **kwargs)
+            if measurement.rows_out is None:
+                measurement.rows_out = count_rows(result)
+            if measurement.bytes is None:
+                measurement.bytes = count_bytes(result)
+            return result
+    return wrapper
+
+def instrumented_op(function):
+    # Measure an op or asset and attach the measurements of it and its nested stages to its output metadata,
+    # the value it returns is passed on unchanged
+    @functools.wraps(function)
+    def wrapper(context, *args, **kwargs):
+        with measure(function.__name__) as measurement:
+            result = function(context, *args, **kwargs)
+            if not isinstance(result, Output):
+                measurement.rows_out = count_rows(result)
+                measurement.bytes = count_bytes(result)
+        if isinstance(result, Output):
+            # The op built its own Output, the measurements join its metadata
+            metadata = dict(result.metadata or {})
+            metadata.update(measurement.metadata())
+            return Output(result.value, output_name=result.output_name, metadata=metadata)
+        context.add_output_metadata(measurement.metadata())
+        return result
+    return wrapper
+
+def prometheus_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+def write_prometheus(measurement):
+    # One file per top level stage, rewritten atomically, with a stage label for the stage and every nested stage
+    lines = []
+    def add(stage, label):
+        for key, value in stage.values().items():
+            lines.append('etl_stage_{}{{stage="{}"}} {}'.format(key, label, value))
+        lines.append('etl_stage_last_run_timestamp_seconds{{stage="{}"}} {:.0f}'.format(label, time.time()))
+        for child in stage.children:
+            add(child, label + '.' + child.name)
+    add(measurement, measurement.name)
+
+    os.makedirs(prometheus_dir, exist_ok=True)
+    path = os.path.join(prometheus_dir, "etl_{}.prom".format(prometheus_name(measurement.name)))
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, 'w') as file:
+        file.write('\n'.join(sorted(lines)) + '\n')
+    os.replace(temp_path, path)
@@ -1,12 +1,21 @@
+import io
+import os
 import json
+import codecs
 import logging
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pymongo
-import csv
-from datetime import datetime
-from dagster import op, Out
-from pymongo import errors
+from datetime import datetime, timedelta
+from dagster import op, Out, Output
+from pymongo import errors, InsertOne, ReplaceOne, UpdateOne
+from pymongo.write_concern import WriteConcern
 import pandas as pd
 import yaml
+from instrument import instrumented_op, record
 
 # Set up a basic logger
 logging.basicConfig(level=logging.INFO)
@@ -17,80 +26,645 @@ def load_config():
         return yaml.safe_load(file)
 
 config = load_config()
-# Connection string to the mongodb
-mongo_connection_string = config['connection']['mongo_connection_string']
+# Number of rows handed to MongoDB at a time and seconds between progress log lines
+ingest_batch_size = config['ingest']['batch_size']
+progress_interval = config['ingest']['progress_interval']
+# Write concern used by the bulk writers, e.g. {'w': 1, 'j': False}
+ingest_write_concern = config['ingest']['write_concern']
+# Only upsert rows past the stored high-water mark instead of re-inserting the whole file
+incremental_ingest = config['ingest']['incremental']
+# MongoDB error code for a duplicate key
+DUPLICATE_KEY_ERROR = 11000
+# Collection holding the high-water mark of every ingested collection
+INGEST_STATE_COLLECTION = 'ingest_state'
+# The people CSV has no change marker: the incremental ingest re-upserts the rows of crashes on or after
+# this many days before the CRASH_DATE watermark, to pick up late and corrected rows of recent crashes
+victims_lookback = timedelta(days=config['ingest']['victims_lookback_days'])
+# Record a resume point after every committed batch, so an interrupted ingest continues where it stopped
+checkpoint_ingest = config['ingest']['checkpoint']
+# Collection holding the resume point of an unfinished ingest of every collection
+INGEST_CHECKPOINT_COLLECTION = 'ingest_checkpoints'
+# Store dates, numbers and a GeoJSON point as native BSON types instead of the exported strings
+typed_ingest = config['ingest']['typed']
+# Exported crash events JSON and people CSV files
+crash_events_file = config['ingest']['crash_events_file']
+crash_victims_file = config['ingest']['crash_victims_file']
+# Typed fields of the crash events documents
+CRASH_EVENTS_DATE_FIELDS = ['crash_date', 'date_police_notified']
+CRASH_EVENTS_INTEGER_FIELDS = ['posted_speed_limit', 'lane_cnt', 'street_no', 'beat_of_occurrence', 'num_units', 'injuries_total', 'injuries_fatal', 'injuries_incapacitating', 'injuries_non_incapacitating', 'injuries_reported_not_evident', 'injuries_no_indication', 'injuries_unknown', 'crash_hour', 'crash_day_of_week', 'crash_month']
+CRASH_EVENTS_FLOAT_FIELDS = ['latitude', 'longitude']
+# Number of parsed CSV chunks allowed to wait for the MongoDB writer
+ingest_queue_size = config['ingest']['queue_size']
+# Size of the blocks the people CSV is cut into on record boundaries; every block is parsed in one read_csv call
+csv_block_bytes = config['ingest']['csv_block_bytes']
+# Threads parsing CSV blocks side by side; read_csv tokenizes without holding the GIL
+csv_parse_workers = config['ingest']['parse_workers']
+# Columns of the rows in the 'data' array of the crash events export
+CRASH_EVENTS_COLUMNS = ['row_id', 'guid', 'meta1', 'created_at', 'meta2', 'updated_at', 'meta3', 'meta4', 'crash_record_id', 'crash_date_est_i', 'crash_date', 'posted_speed_limit', 'traffic_control_device', 'device_condition', 'weather_condition', 'lighting_condition', 'first_crash_type', 'trafficway_type', 'lane_cnt', 'alignment', 'roadway_surface_cond', 'road_defect', 'report_type', 'crash_type', 'intersection_related_i', 'private_property_i', 'hit_and_run_i', 'damage', 'date_police_notified', 'prim_contributory_cause','sec_contributory_cause', 'street_no', 'street_direction', 'street_name', 'beat_of_occurrence', 'photos_taken_i','statements_taken_i', 'dooring_i', 'work_zone_i', 'work_zone_type', 'workers_present_i', 'num_units', 'most_severe_injury', 'injuries_total', 'injuries_fatal', 'injuries_incapacitating', 'injuries_non_incapacitating', 'injuries_reported_not_evident', 'injuries_no_indication', 'injuries_unknown', 'crash_hour', 'crash_day_of_week', 'crash_month', 'latitude', 'longitude', 'location'
+]
+# Fixed format of the dates in the people CSV
+CSV_DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+# Numeric columns of the people CSV that are cast at ingest time
+CSV_INTEGER_COLUMNS = ['AGE', 'VEHICLE_ID', 'SEAT_NO']
+CSV_FLOAT_COLUMNS = ['BAC_RESULT VALUE']
+
+def to_int(value):
+    # Cast an exported value to int, empty or invalid values become None
+    if value is None or value == '':
+        return None
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+def to_float(value):
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_datetime(value):
+    # Exported dates are ISO 8601 strings such as '2024-01-05T17:30:00.000'
+    if isinstance(value, datetime):
+        return value
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+def to_geojson_point(location, latitude, longitude):
+    # Build a GeoJSON point from a 'POINT (lon lat)' location, falling back to the latitude/longitude fields
+    if isinstance(location, str) and location.upper().startswith('POINT'):
+        try:
+            lon, lat = (float(part) for part in location[location.index('(') + 1:location.index(')')].split())
+            return {'type': 'Point', 'coordinates': [lon, lat]}
+        except ValueError:
+            pass
+    if latitude is None or longitude is None or (latitude == 0 and longitude == 0):
+        return None
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+def type_crash_event(document):
+    # Convert the string fields of a crash events document to their BSON types in place
+    for field in CRASH_EVENTS_DATE_FIELDS:
+        if field in document:
+            document[field] = to_datetime(document[field])
+    for field in CRASH_EVENTS_INTEGER_FIELDS:
+        if field in document:
+            document[field] = to_int(document[field])
+    for field in CRASH_EVENTS_FLOAT_FIELDS:
+        if field in document:
+            document[field] = to_float(document[field])
+    point = to_geojson_point(document.get('location'), document.get('latitude'), document.get('longitude'))
+    if point is not None:
+        # Documents without a point leave the field out so the 2dsphere index skips them
+        document['location_point'] = point
+    return document
+
+class JsonStreamReader:
+    # Reads a JSON document from a binary file a block at a time, so values can be
+    # decoded one by one without holding the whole file in memory
+    def __init__(self, file, block_size=1 << 20):
+        self.file = file
+        self.block_size = block_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        # Counted from the current position, so a reader on a file seeked to a checkpoint reports file offsets
+        self.bytes_read = file.tell()
+
+    def _fill(self):
+        # Drop the consumed part of the buffer and append the next block of the file
+        block = self.file.read(self.block_size)
+        self.bytes_read += len(block)
+        if not block:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(block, final=self.eof)
+        self.pos = 0
+
+    def offset(self):
+        # File offset of the next unconsumed character: the bytes read minus the undecoded rest of the buffer
+        # and the bytes of an incomplete character still held by the utf-8 decoder
+        pending = self.text_decoder.getstate()[0]
+        return self.bytes_read - len(self.buffer[self.pos:].encode('utf-8')) - len(pending)
+
+    def peek(self):
+        # Return the next non-whitespace character without consuming it
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self._fill()
+
+    def expect(self, *chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError("Unexpected character {!r} in JSON stream, expected one of {}".format(char, chars))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        # Decode the next complete value; a value cut off at the end of the buffer is retried
+        # once more of the file has been read
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            if end == len(self.buffer) and not self.eof:
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+def stream_array_entries(reader, resume=False):
+    # Yield the entries of an array one at a time; with resume the reader is already right after an entry,
+    # or at the end of the file when the checkpoint was saved after the last entry
+    if resume:
+        if reader.peek() == '':
+            return
+    else:
+        reader.expect('[')
+        if reader.peek() == ']':
+            reader.expect(']')
+            return
+        yield reader.decode()
+    while reader.expect(',', ']') == ',':
+        yield reader.decode()
+
+def stream_json_data_entries(reader, key='data', resume=False):
+    # Walk the top level object of the export and yield the entries of its 'data' array one at a time,
+    # every other top level value (e.g. 'meta') is decoded and thrown away. With resume the reader was
+    # positioned right after an entry of the 'data' array by a checkpoint
+    if resume:
+        yield from stream_array_entries(reader, resume=True)
+        if reader.peek() == '' or reader.expect(',', '}') == '}':
+            return
+    else:
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+    while True:
+        name = reader.decode()
+        reader.expect(':')
+        if name == key:
+            yield from stream_array_entries(reader)
+        else:
+            reader.decode()
+        if reader.expect(',', '}') == '}':
+            return
+
+def chunked(iterable, size):
+    # Group an iterable into lists of at most size items
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class BulkWriter:
+    # Sends batches of documents to MongoDB as unordered bulk writes and keeps running totals.
+    # A failed document (e.g. a duplicate key) does not stop the rest of its batch.
+    # With a key the documents are upserted on that field instead of inserted
+    def __init__(self, collection, key=None, write_concern=None):
+        if write_concern is None:
+            write_concern = ingest_write_concern
+        self.collection = collection.with_options(write_concern=WriteConcern(**write_concern))
+        self.key = key
+        self.inserted = 0
+        self.upserted = 0
+        self.modified = 0
+        self.duplicates = 0
+        self.failed = 0
+
+    def write(self, documents):
+        if self.key is None:
+            requests = [InsertOne(document) for document in documents]
+        else:
+            requests = [ReplaceOne({self.key: document[self.key]}, document, upsert=True) for document in documents]
+        if not requests:
+            return
+        try:
+            result = self.collection.bulk_write(requests, ordered=False)
+            if result.acknowledged:
+                self.inserted += result.inserted_count
+                self.upserted += result.upserted_count
+                self.modified += result.modified_count
+        except errors.BulkWriteError as bwe:
+            # Count the failures from the bulk error details instead of stopping the batch
+            self.inserted += bwe.details.get('nInserted', 0)
+            self.upserted += bwe.details.get('nUpserted', 0)
+            self.modified += bwe.details.get('nModified', 0)
+            for write_error in bwe.details.get('writeErrors', []):
+                if write_error.get('code') == DUPLICATE_KEY_ERROR:
+                    self.duplicates += 1
+                else:
+                    self.failed += 1
+                    logger.error("Write error: %s" % write_error.get('errmsg'))
+
+    def changed(self):
+        # Documents inserted or modified so far, unchanged replacements do not count
+        return self.inserted + self.upserted + self.modified
+
+    def totals(self):
+        return {"inserted": self.inserted, "upserted": self.upserted, "modified": self.modified,
+                "duplicates": self.duplicates, "failed": self.failed}
+
+def get_watermark(db, name):
+    # Return the stored high-water mark of a collection, or an empty state if it was never ingested
+    state = db[INGEST_STATE_COLLECTION].find_one({'_id': name})
+    return state if state else {}
+
+def save_watermark(db, name, watermark):
+    # Store the high-water mark reached by the last successful ingest of a collection, keeping its change counter
+    db[INGEST_STATE_COLLECTION].update_one(
+        {'_id': name},
+        {'$set': {'watermark': watermark, 'saved_at': datetime.utcnow()}},
+        upsert=True
+    )
+
+def record_changes(db, name, changed):
+    # Count the documents of a collection inserted or modified by the pipeline, right after every write, so
+    # the transform cache sees changes of failed runs too
+    if changed:
+        db[INGEST_STATE_COLLECTION].update_one(
+            {'_id': name},
+            {'$inc': {'changes': changed}, '$set': {'changed_at': datetime.utcnow()}},
+            upsert=True
+        )
+
+def file_fingerprint(file_path):
+    # Identifies the version of an input file a checkpoint belongs to
+    stat = os.stat(file_path)
+    return {'file_path': os.path.abspath(file_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def load_checkpoint(db, name, fingerprint):
+    # Return the checkpoint of an unfinished ingest of the same file, or None to start from the beginning
+    if not checkpoint_ingest:
+        return None
+    checkpoint = db[INGEST_CHECKPOINT_COLLECTION].find_one({'_id': name})
+    if checkpoint is None:
+        return None
+    if any(checkpoint.get(field) != value for field, value in fingerprint.items()):
+        logger.info("{}: the file changed since the checkpoint, starting from the beginning".format(name))
+        return None
+    logger.info("{}: resuming after batch {} at row {} (byte {})".format(
+        name, checkpoint['batch'], checkpoint['rows'], checkpoint['offset']))
+    return checkpoint
+
+def save_checkpoint(db, name, fingerprint, offset, rows, batch, max_key=None):
+    # Store the resume point after a committed batch: the file offset of the next row, the rows read so far,
+    # the batch number and the high-water mark reached so far
+    document = dict(fingerprint, _id=name, offset=offset, rows=rows, batch=batch, max_key=max_key,
+                    saved_at=datetime.utcnow())
+    db[INGEST_CHECKPOINT_COLLECTION].replace_one({'_id': name}, document, upsert=True)
+
+def clear_checkpoint(db, name):
+    db[INGEST_CHECKPOINT_COLLECTION].delete_one({'_id': name})
+
+def produce_in_background(iterable, maxsize):
+    # Run the iterable in a worker thread and hand its items over through a bounded queue,
+    # so producing the next item overlaps with consuming the current one
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+    failure = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def worker():
+        try:
+            for item in iterable:
+                put(item)
+                if stop.is_set():
+                    return
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            put(done)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+        if failure:
+            raise failure[0]
+    finally:
+        stop.set()
+        thread.join()
+
+def read_record_blocks(csv_file, block_bytes):
+    # Split the rest of a CSV file into blocks of about block_bytes that end on a record boundary and yield
+    # (block, file offset after the block). A newline ends a record when the quotes before it are balanced;
+    # every block starts on a record boundary, so the quotes are counted from the start of the block
+    rest = b''
+    while True:
+        data = csv_file.read(block_bytes)
+        if not data:
+            break
+        block = rest + data
+        end = block.rfind(b'\n')
+        quotes = block.count(b'"', 0, end) if end != -1 else 0
+        while end != -1 and quotes % 2:
+            # The newline is inside a quoted value, step back to the previous one
+            previous = block.rfind(b'\n', 0, end)
+            quotes -= block.count(b'"', previous + 1, end)
+            end = previous
+        if end == -1:
+            # No complete record yet, read on
+            rest = block
+            continue
+        rest = block[end + 1:]
+        yield block[:end + 1], csv_file.tell() - len(rest)
+    if rest:
+        yield rest, csv_file.tell()
+
+def parse_crash_victims_block(header, block, since=None):
+    # Parse one block of the people CSV, parse CRASH_DATE and cast the numeric columns vectorized, and return
+    # (rows read, documents, max CRASH_DATE); with since only the rows of crashes on or after it are kept
+    chunk = pd.read_csv(io.BytesIO(header + block), dtype=str, keep_default_na=False)
+    rows = len(chunk)
+    chunk['CRASH_DATE'] = pd.to_datetime(chunk['CRASH_DATE'], format=CSV_DATE_FORMAT, errors='coerce')
+    if since is not None:
+        # A copy, the columns are cast in place below
+        chunk = chunk[chunk['CRASH_DATE'] >= since].copy()
+
+    crash_dates = chunk['CRASH_DATE'].dropna()
+    max_crash_date = crash_dates.max().to_pydatetime() if len(crash_dates) else None
+
+    # MongoDB cannot store NaT/NA, missing values are written as null
+    chunk['CRASH_DATE'] = chunk['CRASH_DATE'].astype(object).where(chunk['CRASH_DATE'].notna(), None)
+    for col in CSV_INTEGER_COLUMNS + CSV_FLOAT_COLUMNS:
+        if col in chunk.columns:
+            values = pd.to_numeric(chunk[col], errors='coerce')
+            if col in CSV_INTEGER_COLUMNS:
+                values = values.round().astype('Int64')
+            chunk[col] = values.astype(object).where(values.notna(), None)
+
+    return rows, chunk.to_dict('records'), max_crash_date
+
+def read_crash_victims_batches(csv_file, block_bytes, since=None, offset=None, workers=None):
+    # Cut the people CSV into blocks of whole records, parse the blocks in a thread pool and yield
+    # (rows read, documents, max CRASH_DATE, offset after the block) per block in file order.
+    # With an offset the rows before it are skipped with a seek
+    if workers is None:
+        workers = csv_parse_workers
+    header = csv_file.readline()
+    if offset is not None:
+        csv_file.seek(offset)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        # At most one block per worker is parsed ahead of the one being yielded
+        pending = deque()
+        for block, end_offset in read_record_blocks(csv_file, block_bytes):
+            pending.append((pool.submit(parse_crash_victims_block, header, block, since), end_offset))
+            if len(pending) > workers:
+                future, block_end = pending.popleft()
+                yield future.result() + (block_end,)
+        while pending:
+            future, block_end = pending.popleft()
+            yield future.result() + (block_end,)
+
+class ProgressLogger:
+    # Periodically logs rows/sec and bytes/sec while a file is being ingested
+    def __init__(self, name, interval=progress_interval):
+        self.name = name
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_logged = self.started
+
+    def update(self, rows, bytes_read, final=False):
+        now = time.monotonic()
+        if not final and now - self.last_logged < self.interval:
+            return
+        self.last_logged = now
+        elapsed = max(now - self.started, 1e-9)
+        logger.info("{}: {} rows, {:.1f} MB read in {:.1f}s ({:.0f} rows/sec, {:.2f} MB/sec)".format(
+            self.name, rows, bytes_read / 1e6, elapsed, rows / elapsed, bytes_read / 1e6 / elapsed))
  
-@op(out=Out(bool))
-def extract_and_store_json_data_in_mongodb() -> bool: 
+def store_crash_events(client, file_path=None, database="TrafficIncidentsDB"):
+    # Stream the crash events export into MongoDB, returns the success flag and the write totals
     result = False
-    client = pymongo.MongoClient(mongo_connection_string)
-    db = client["TrafficIncidentsDB"]
+    totals = {}
+    db = client[database]
     collection = db['traffic_crash_events']
     # Indexing is created for crash_record_id for quicker access
     collection.create_index([('crash_record_id', pymongo.ASCENDING)], unique=False)
+    # Compound index backing the crash_date range read by the transform step
+    collection.create_index([('crash_date', pymongo.ASCENDING), ('crash_record_id', pymongo.ASCENDING)], unique=False)
+    if typed_ingest:
+        collection.create_index([('location_point', pymongo.GEOSPHERE)])
 
-    file_path = "D:\\traff_pep_dataset.json"  # Use double backslashes for Windows paths
+    if file_path is None:
+        file_path = crash_events_file
 
     try:
-        # Load JSON data from file
-        with open(file_path, 'r') as file:
-            full_data = json.load(file)
- 
-        data_entries = full_data['data']
-        columns = ['row_id', 'guid', 'meta1', 'created_at', 'meta2', 'updated_at', 'meta3', 'meta4', 'crash_record_id', 'crash_date_est_i', 'crash_date', 'posted_speed_limit', 'traffic_control_device', 'device_condition', 'weather_condition', 'lighting_condition', 'first_crash_type', 'trafficway_type', 'lane_cnt', 'alignment', 'roadway_surface_cond', 'road_defect', 'report_type', 'crash_type', 'intersection_related_i', 'private_property_i', 'hit_and_run_i', 'damage', 'date_police_notified', 'prim_contributory_cause','sec_contributory_cause', 'street_no', 'street_direction', 'street_name', 'beat_of_occurrence', 'photos_taken_i','statements_taken_i', 'dooring_i', 'work_zone_i', 'work_zone_type', 'workers_present_i', 'num_units', 'most_severe_injury', 'injuries_total', 'injuries_fatal', 'injuries_incapacitating', 'injuries_non_incapacitating', 'injuries_reported_not_evident', 'injuries_no_indication', 'injuries_unknown', 'crash_hour', 'crash_day_of_week', 'crash_month', 'latitude', 'longitude', 'location'
-        ]
+        fingerprint = file_fingerprint(file_path)
+        checkpoint = load_checkpoint(db, 'traffic_crash_events', fingerprint)
+        # Stream the 'data' array of the export instead of loading the whole file, so memory
+        # stays bounded by the chunk size rather than the file size
+        with open(file_path, 'rb') as file:
+            if checkpoint:
+                # The rows before the checkpoint were committed by the interrupted run
+                file.seek(checkpoint['offset'])
+            reader = JsonStreamReader(file)
+            progress = ProgressLogger("traffic_crash_events")
+            rows = checkpoint['rows'] if checkpoint else 0
+            batch = checkpoint['batch'] if checkpoint else 0
 
-        # Transform data into dictionaries expected by MongoDB
-        data_dicts = [dict(zip(columns, entry)) for entry in data_entries]
- 
-        for data_dict in data_dicts:
-            # Use row_id as the unique identifier for MongoDB documents
-            data_dict["_id"] = data_dict["row_id"]
-            try:
-                # Insert data into MongoDB
-                collection.insert_one(data_dict)
-            except errors.DuplicateKeyError as dke:
-                logger.error("Duplicate Key Error: %s" % dke)
-                continue
+            if incremental_ingest:
+                # Only rows updated after the last successful run are upserted on their _id
+                watermark = get_watermark(db, 'traffic_crash_events').get('watermark') or 0
+                writer = BulkWriter(collection, key='_id')
+            else:
+                watermark = None
+                writer = BulkWriter(collection)
+            max_updated_at = watermark
+            if watermark is not None and checkpoint and checkpoint.get('max_key') is not None:
+                max_updated_at = max(max_updated_at, checkpoint['max_key'])
+
+            entries = stream_json_data_entries(reader, resume=checkpoint is not None)
+            for chunk in chunked(entries, ingest_batch_size):
+                # Transform the chunk into dictionaries expected by MongoDB
+                data_dicts = [dict(zip(CRASH_EVENTS_COLUMNS, entry)) for entry in chunk]
+                rows += len(data_dicts)
+
+                if watermark is not None:
+                    # updated_at is kept as exported, so the delta is picked before any row is typed
+                    data_dicts = [data_dict for data_dict in data_dicts if (data_dict['updated_at'] or 0) > watermark]
+                    for data_dict in data_dicts:
+                        max_updated_at = max(max_updated_at, data_dict['updated_at'])
+                for data_dict in data_dicts:
+                    # Use row_id as the unique identifier for MongoDB documents
+                    data_dict["_id"] = data_dict["row_id"]
+                    if typed_ingest:
+                        type_crash_event(data_dict)
+                # Write the chunk into MongoDB as one unordered bulk write
+                changed = writer.changed()
+                writer.write(data_dicts)
+                record_changes(db, 'traffic_crash_events', writer.changed() - changed)
+                batch += 1
+                # Resume after this batch next time, unless a row could not be written and has to be retried
+                if checkpoint_ingest and writer.failed == 0:
+                    save_checkpoint(db, 'traffic_crash_events', fingerprint, reader.offset(), rows, batch, max_updated_at)
+
+                progress.update(rows, reader.bytes_read)
+            progress.update(rows, reader.bytes_read, final=True)
+            record(rows_in=rows, rows_out=writer.changed(), bytes=reader.bytes_read)
+            totals = writer.totals()
+
+        # Move the high-water mark only when every row of the delta was written
+        if watermark is not None and writer.failed == 0:
+            save_watermark(db, 'traffic_crash_events', max_updated_at)
+        if writer.failed == 0:
+            clear_checkpoint(db, 'traffic_crash_events')
  
-        logger.info("Data successfully loaded and inserted into MongoDB.")
+        logger.info("Data successfully loaded and inserted into MongoDB: {}".format(totals))
         result = True
  
     except Exception as e:
         logger.error("An error occurred: {}".format(e))
         result = False
  
-    return result
+    return result, totals
 
-@op(out=Out(bool))
-def ingest_csv_data_to_mongodb() -> bool:
-    client = pymongo.MongoClient(mongo_connection_string)
-    db = client["TrafficIncidentsDB"]
+@op(out=Out(bool), required_resource_keys={"mongo"})
+@instrumented_op
+def extract_and_store_json_data_in_mongodb(context) -> bool: 
+    # Shared MongoClient of the run
+    result, totals = store_crash_events(context.resources.mongo)
+    return Output(result, metadata=totals)
+
+def store_crash_victims(client, file_path=None, database="TrafficIncidentsDB"):
+    # Parse the people CSV into MongoDB, returns the success flag and the write totals
+    db = client[database]
     collection = db['crash_victims']
     #Indexing is created for CRASH_RECORD_ID for quicker access
     collection.create_index([('CRASH_RECORD_ID', pymongo.ASCENDING)], unique=False)
-    file_path = "D:\\Traffic_Crashes_-_People.csv"  # Use double backslashes for Windows paths
-    
+    # Compound index backing the CRASH_DATE range read by the transform step
+    collection.create_index([('CRASH_DATE', pymongo.ASCENDING), ('CRASH_RECORD_ID', pymongo.ASCENDING)], unique=False)
+    # PERSON_ID identifies a row when upserting the delta
+    collection.create_index([('PERSON_ID', pymongo.ASCENDING)], unique=False)
+    if file_path is None:
+        file_path = crash_victims_file
+
     try:
-        with open(file_path, 'r') as csv_file:
-            reader = csv.DictReader(csv_file)
-            all_data = []
-
-            for row in reader:
-                # Parse CRASH_DATE and DATE_POLICE_NOTIFIED to datetime objects
-                if 'CRASH_DATE' in row:
-                    row['CRASH_DATE'] = datetime.strptime(row['CRASH_DATE'], '%m/%d/%Y %I:%M:%S %p')
-        
-                all_data.append(row)
-            collection.insert_many(all_data)
-        logger.info("CSV data successfully loaded and inserted into MongoDB.")
-        return True
-
-    except pymongo.errors.BulkWriteError as bwe:
-        logger.error("Bulk write error occurred due to duplicate keys or other issues.")
-        logger.error(bwe.details)
-        return False
+        fingerprint = file_fingerprint(file_path)
+        checkpoint = load_checkpoint(db, 'crash_victims', fingerprint)
+        with open(file_path, 'rb') as csv_file:
+            if incremental_ingest:
+                # Only rows of crashes on or after the lookback window before the last stored CRASH_DATE are
+                # upserted on PERSON_ID. The bound is inclusive and the upsert idempotent, so the rows of the
+                # watermark day itself are always re-read and no PERSON_ID tie-break is needed. Corrections
+                # of older crashes need a full ingest (ingest.incremental: false or a removed ingest_state)
+                watermark = get_watermark(db, 'crash_victims').get('watermark')
+                since = watermark - victims_lookback if watermark is not None else None
+                writer = BulkWriter(collection, key='PERSON_ID')
+            else:
+                watermark, since = None, None
+                writer = BulkWriter(collection)
+            max_crash_date = watermark
+            progress = ProgressLogger("crash_victims")
+            rows, bytes_read, block_number = 0, 0, 0
+            if checkpoint:
+                # The rows before the checkpoint were committed by the interrupted run, including their high-water mark
+                rows, bytes_read, block_number = checkpoint['rows'], checkpoint['offset'], checkpoint['batch']
+                # Checkpoints of earlier versions held (CRASH_DATE, PERSON_ID), a lower watermark only re-reads more rows
+                if incremental_ingest and isinstance(checkpoint.get('max_key'), datetime):
+                    max_crash_date = max(max_crash_date or checkpoint['max_key'], checkpoint['max_key'])
+
+            # Parsing runs in background threads and hands finished blocks to the writer through
+            # a bounded queue, so CSV parsing and MongoDB writes overlap
+            batches = read_crash_victims_batches(csv_file, csv_block_bytes, since,
+                                                 checkpoint['offset'] if checkpoint else None)
+            for chunk_rows, documents, block_max, bytes_read in produce_in_background(batches, ingest_queue_size):
+                if incremental_ingest and block_max is not None:
+                    max_crash_date = max(max_crash_date or block_max, block_max)
+                # Write the block into MongoDB as unordered bulk writes of batch_size documents
+                for batch in chunked(documents, ingest_batch_size):
+                    changed = writer.changed()
+                    writer.write(batch)
+                    record_changes(db, 'crash_victims', writer.changed() - changed)
+                block_number += 1
+
+                rows += chunk_rows
+                # Resume after this block next time, unless a row could not be written and has to be retried
+                if checkpoint_ingest and writer.failed == 0:
+                    save_checkpoint(db, 'crash_victims', fingerprint, bytes_read, rows, block_number, max_crash_date)
+                progress.update(rows, bytes_read)
+            progress.update(rows, bytes_read, final=True)
+            record(rows_in=rows, rows_out=writer.changed(), bytes=bytes_read)
+        totals = writer.totals()
+
+        # Move the high-water mark only when every row of the delta was written
+        if incremental_ingest and writer.failed == 0 and max_crash_date is not None:
+            save_watermark(db, 'crash_victims', max_crash_date)
+        if writer.failed == 0:
+            clear_checkpoint(db, 'crash_victims')
+        logger.info("CSV data successfully loaded and inserted into MongoDB: {}".format(totals))
+        return True, totals
 
     except Exception as e:
         logger.error(f"An error occurred: {e}")
-        return False
\ No newline at end of file
+        return False, {}
+
+@op(out=Out(bool), required_resource_keys={"mongo"})
+@instrumented_op
+def ingest_csv_data_to_mongodb(context) -> bool:
+    # Shared MongoClient of the run
+    result, totals = store_crash_victims(context.resources.mongo)
+    return Output(result, metadata=totals)
+
+@op(out=Out(bool), required_resource_keys={"mongo"})
+@instrumented_op
+def migrate_crash_events_to_typed(context) -> bool:
+    # One-off migration of an existing traffic_crash_events collection from exported strings to BSON types
+    # Shared MongoClient of the run
+    client = context.resources.mongo
+    db = client["TrafficIncidentsDB"]
+    collection = db['traffic_crash_events']
+    fields = CRASH_EVENTS_DATE_FIELDS + CRASH_EVENTS_INTEGER_FIELDS + CRASH_EVENTS_FLOAT_FIELDS + ['location']
+    # Documents still holding a string crash_date have not been migrated yet, so the migration can be resumed
+    cursor = collection.find({'crash_date': {'$type': 'string'}}, {field: 1 for field in fields}, batch_size=ingest_batch_size)
+    migrated = 0
+
+    try:
+        for batch in chunked(cursor, ingest_batch_size):
+            requests = []
+            for document in batch:
+                document_id = document.pop('_id')
+                requests.append(UpdateOne({'_id': document_id}, {'$set': type_crash_event(document)}))
+            result = collection.bulk_write(requests, ordered=False)
+            record_changes(db, 'traffic_crash_events', result.modified_count)
+            migrated += len(requests)
+        collection.create_index([('location_point', pymongo.GEOSPHERE)])
+        record(rows_out=migrated)
+        logger.info("{} traffic_crash_events documents migrated to typed fields.".format(migrated))
+        return Output(True, metadata={"migrated": migrated})
+
+    except Exception as e:
+        logger.error("An error occurred: {}".format(e))
+        return Output(False, metadata={"migrated": migrated})
\ No newline at end of file
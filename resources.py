@@ -0,0 +1,80 @@
+import atexit
+import threading
+import yaml
+from dagster import resource, fs_io_manager
+from pymongo import MongoClient
+from sqlalchemy import create_engine
+from instrument import CountingCursor
+
+def load_config():
+    with open('config.yaml', 'r') as file:
+        return yaml.safe_load(file)
+
+config = load_config()
+# Connection string to the target database
+postgres_connection_string = config['connection']['postgres_connection_string']
+# Connection string to the mongodb
+mongo_connection_string = config['connection']['mongo_connection_string']
+# Pool sizes and timeouts of the shared clients
+pool_config = config['pool']
+
+# One engine and one MongoClient per connection string and process, shared by every op
+_engines = {}
+_mongo_clients = {}
+_lock = threading.Lock()
+
+def get_engine(connection_string=postgres_connection_string):
+    with _lock:
+        engine = _engines.get(connection_string)
+        if engine is None:
+            engine = create_engine(
+                connection_string,
+                pool_size=pool_config['postgres_pool_size'],
+                max_overflow=pool_config['postgres_max_overflow'],
+                pool_timeout=pool_config['postgres_pool_timeout'],
+                pool_recycle=pool_config['postgres_pool_recycle'],
+                # Check connections before use so a restarted server does not fail the op
+                pool_pre_ping=pool_config['postgres_pre_ping'],
+                # The cursor factory counts the round trips for the stage measurements
+                connect_args={'connect_timeout': pool_config['postgres_connect_timeout'], 'cursor_factory': CountingCursor}
+            )
+            _engines[connection_string] = engine
+        return engine
+
+def get_mongo_client(connection_string=mongo_connection_string):
+    with _lock:
+        client = _mongo_clients.get(connection_string)
+        if client is None:
+            client = MongoClient(
+                connection_string,
+                maxPoolSize=pool_config['mongo_max_pool_size'],
+                serverSelectionTimeoutMS=pool_config['mongo_server_selection_timeout_ms'],
+                connectTimeoutMS=pool_config['mongo_connect_timeout_ms']
+            )
+            _mongo_clients[connection_string] = client
+        return client
+
+@atexit.register
+def close_all():
+    # Release the pooled connections when the process exits
+    with _lock:
+        for engine in _engines.values():
+            engine.dispose()
+        for client in _mongo_clients.values():
+            client.close()
+        _engines.clear()
+        _mongo_clients.clear()
+
+@resource
+def postgres_resource(init_context):
+    # Pooled SQLAlchemy engine of the target PostgreSQL database
+    return get_engine()
+
+@resource
+def mongo_resource(init_context):
+    # Pooled MongoClient of the source MongoDB server
+    return get_mongo_client()
+
+# Resources of every job in the repository; op outputs are kept on disk so the multiprocess executor
+# can hand them between processes
+resource_defs = {"postgres": postgres_resource, "mongo": mongo_resource, "io_manager": fs_io_manager}
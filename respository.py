@@ -1,9 +1,17 @@
-from dagster import repository, job, graph
+from dagster import repository, job, graph, multiprocess_executor, in_process_executor, with_resources
 from main import *
 from transform import *
 from vis import *
+from resources import resource_defs, config
+from assets import crash_assets, monthly_crash_facts_job
 
-@job
+# The seven visualizations only depend on the load, so the multiprocess executor runs them side by side
+if config['execution']['executor'] == 'multiprocess':
+    executor_def = multiprocess_executor.configured({"max_concurrent": config['execution']['max_concurrent']})
+else:
+    executor_def = in_process_executor
+
+@job(resource_defs=resource_defs, executor_def=executor_def)
 def dagster_etl_pipeline():
     # Start extraction process
     traffic_crash_events_data = extract_and_store_json_data_in_mongodb()
@@ -21,6 +29,13 @@ def dagster_etl_pipeline():
     visualize_cell_phone_impact(loaded_data)
     visualize_geographic_patterns(loaded_data)
 
+@job(resource_defs=resource_defs)
+def migrate_crash_events_job():
+    # One-off conversion of an existing traffic_crash_events collection to typed fields
+    migrate_crash_events_to_typed()
+
 @repository
 def my_repository():
-    return [dagster_etl_pipeline]
+    # The monthly partitioned assets reload a single month of the star schema without touching the others
+    return [dagster_etl_pipeline, migrate_crash_events_job, monthly_crash_facts_job,
+            *with_resources(crash_assets, resource_defs)]
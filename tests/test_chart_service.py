@@ -0,0 +1,52 @@
+from datetime import datetime
+import pytest
+
+chart_service = pytest.importorskip("chart_service")
+
+def test_no_filters():
+    assert chart_service.build_filters({}) == ("TRUE", {})
+
+def test_date_range():
+    where, params = chart_service.build_filters({'start': ['2024-01-01'], 'end': ['2024-02-01T06:00:00']})
+    assert "crash_date >= :start" in where and "crash_date < :end" in where
+    assert params == {'start': datetime(2024, 1, 1), 'end': datetime(2024, 2, 1, 6)}
+
+@pytest.mark.parametrize('value', ['yesterday', '2024-13-01', ''])
+def test_bad_date(value):
+    with pytest.raises(ValueError):
+        chart_service.build_filters({'start': [value]})
+
+def test_hours_default_to_the_whole_day():
+    _, params = chart_service.build_filters({'hour_from': ['7']})
+    assert (params['hour_from'], params['hour_to']) == (7, 23)
+    _, params = chart_service.build_filters({'hour_to': ['9']})
+    assert (params['hour_from'], params['hour_to']) == (0, 9)
+
+@pytest.mark.parametrize('query', [{'hour_from': ['24']}, {'hour_to': ['-1']}, {'hour_from': ['seven']}])
+def test_bad_hours(query):
+    with pytest.raises(ValueError):
+        chart_service.build_filters(query)
+
+def test_lists():
+    _, params = chart_service.build_filters({'weather': ['RAIN,SNOW', ' FOG '], 'lighting': ['DAYLIGHT']})
+    assert params == {'weather': ['RAIN', 'SNOW', 'FOG'], 'lighting': ['DAYLIGHT']}
+
+def test_bbox():
+    where, params = chart_service.build_filters({'bbox': ['-87.9,41.6,-87.5,42.0']})
+    assert "longitude BETWEEN :min_lon AND :max_lon" in where
+    assert params == {'min_lon': -87.9, 'min_lat': 41.6, 'max_lon': -87.5, 'max_lat': 42.0}
+
+@pytest.mark.parametrize('bbox', ['-87.9,41.6,-87.5', '-87.9,41.6,-87.5,42.0,1', 'a,b,c,d', 'nan,41.6,-87.5,42.0',
+                                  '-87.9,41.6,inf,42.0', '-87.5,41.6,-87.9,42.0'])
+def test_bad_bbox(bbox):
+    with pytest.raises(ValueError):
+        chart_service.build_filters({'bbox': [bbox]})
+
+def test_grid():
+    assert chart_service.parse_grid({'grid': ['0.05']}) == 0.05
+    assert chart_service.parse_grid({}) == chart_service.geo_grid_size
+
+@pytest.mark.parametrize('grid', ['0', '-0.01', 'nan', 'inf', 'coarse'])
+def test_bad_grid(grid):
+    with pytest.raises(ValueError):
+        chart_service.parse_grid({'grid': [grid]})
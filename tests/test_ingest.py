@@ -0,0 +1,79 @@
+import io
+import json
+import pytest
+
+main = pytest.importorskip("main")
+
+DOCUMENT = {
+    'meta': {'view': {'columns': [1, 2]}},
+    # Multi-byte characters make character and byte positions differ
+    'data': [[i, 'straße ' * i, {'n': i}] for i in range(25)],
+    'tail': True
+}
+
+def encode(document):
+    return json.dumps(document, ensure_ascii=False).encode('utf-8')
+
+def read_until(raw, count, block_size=7):
+    # Read the first count entries and return them with the reader offset after the last one
+    reader = main.JsonStreamReader(io.BytesIO(raw), block_size=block_size)
+    entries = main.stream_json_data_entries(reader)
+    first = [next(entries) for _ in range(count)]
+    return first, reader.offset()
+
+def resume(raw, offset, block_size=7):
+    file = io.BytesIO(raw)
+    file.seek(offset)
+    return list(main.stream_json_data_entries(main.JsonStreamReader(file, block_size=block_size), resume=True))
+
+@pytest.mark.parametrize('count', [1, 10, 24, 25])
+def test_resume_inside_data_array(count):
+    raw = encode(DOCUMENT)
+    first, offset = read_until(raw, count)
+    assert first + resume(raw, offset) == DOCUMENT['data']
+
+def test_offset_points_after_entry():
+    raw = encode(DOCUMENT)
+    _, offset = read_until(raw, 3, block_size=5)
+    assert raw[offset:].lstrip().startswith(b',')
+
+def test_resume_at_end_of_file():
+    # A checkpoint saved after the last, partial chunk points at the end of the file
+    raw = encode(DOCUMENT) + b'\n'
+    reader = main.JsonStreamReader(io.BytesIO(raw), block_size=7)
+    assert list(main.stream_json_data_entries(reader)) == DOCUMENT['data']
+    assert resume(raw, reader.offset()) == []
+    assert resume(raw, len(raw)) == []
+
+def test_resume_with_data_array_last():
+    document = {'meta': {}, 'data': [[1], [2], [3]]}
+    raw = encode(document)
+    first, offset = read_until(raw, 2)
+    assert first + resume(raw, offset) == document['data']
+
+CSV = (b'PERSON_ID,CRASH_DATE,NOTE\n'
+       b'P1,01/01/2024 01:00:00 AM,plain\n'
+       b'P2,01/01/2024 02:00:00 AM,"quoted\nnewline"\n'
+       b'P3,01/01/2024 03:00:00 AM,"escaped ""quote"" and\n\nblank lines"\n'
+       b'\n'
+       b'P4,01/01/2024 04:00:00 AM,last')
+
+@pytest.mark.parametrize('block_bytes', [1, 5, 16, 40, 1000])
+def test_record_blocks_end_on_record_boundaries(block_bytes):
+    file = io.BytesIO(CSV)
+    header = file.readline()
+    blocks = list(main.read_record_blocks(file, block_bytes))
+    assert b''.join(block for block, _ in blocks) == CSV[len(header):]
+    position = len(header)
+    for block, end_offset in blocks:
+        position += len(block)
+        assert end_offset == position
+        # Every block holds whole records, so the quotes are balanced
+        assert block.count(b'"') % 2 == 0
+
+def test_record_blocks_resume_from_offset():
+    file = io.BytesIO(CSV)
+    file.readline()
+    blocks = list(main.read_record_blocks(file, 16))
+    file.seek(blocks[0][1])
+    assert b''.join(block for block, _ in main.read_record_blocks(file, 16)) == b''.join(block for block, _ in blocks[1:])
@@ -0,0 +1,56 @@
+from datetime import datetime
+import pytest
+
+pd = pytest.importorskip("pandas")
+transform = pytest.importorskip("transform")
+
+def test_month_partitions_cover_the_range():
+    partitions = transform.date_partitions(datetime(2023, 11, 15), 'month', until=datetime(2024, 2, 10))
+    assert partitions == [
+        (datetime(2023, 11, 15), datetime(2023, 12, 1)),
+        (datetime(2023, 12, 1), datetime(2024, 1, 1)),
+        (datetime(2024, 1, 1), datetime(2024, 2, 1)),
+        # The last window is open, so crashes newer than until are not missed
+        (datetime(2024, 2, 1), None)
+    ]
+
+def test_week_partitions():
+    partitions = transform.date_partitions(datetime(2024, 1, 1), 'week', until=datetime(2024, 1, 20))
+    assert [start for start, _ in partitions] == [datetime(2024, 1, 1), datetime(2024, 1, 8), datetime(2024, 1, 15)]
+    assert partitions[0][1] == datetime(2024, 1, 8)
+    assert partitions[-1][1] is None
+
+def test_start_at_or_after_until_gives_one_open_partition():
+    assert transform.date_partitions(datetime(2024, 3, 1), 'month', until=datetime(2024, 3, 1)) == [(datetime(2024, 3, 1), None)]
+
+def test_month_bounds_close_the_last_month():
+    bounds = transform.month_bounds(datetime(2024, 11, 20), until=datetime(2025, 1, 5))
+    assert bounds == [(datetime(2024, 11, 1), datetime(2024, 12, 1)), (datetime(2024, 12, 1), datetime(2025, 1, 1)),
+                      (datetime(2025, 1, 1), datetime(2025, 2, 1))]
+
+def crash_frames():
+    events = pd.DataFrame({'crash_record_id': ['a', 'b', 'c', 'd', 'e'],
+                           'crash_date': pd.date_range('2024-01-01', periods=5, freq='D')})
+    # Crash 'c' has no victims, 'a' and 'd' have two
+    victims = pd.DataFrame({'CRASH_RECORD_ID': ['a', 'b', 'a', 'd', 'e', 'd'],
+                            'AGE': [30.0, 41.0, 12.0, 65.0, 23.0, 8.0]})
+    return events, victims
+
+@pytest.mark.parametrize('partitions', [1, 2, 3, 7])
+def test_partitioned_join_matches_the_join(partitions):
+    events, victims = crash_frames()
+    buckets = list(transform.join_partitioned(events, victims, partitions))
+    assert len(buckets) == partitions
+    expected = transform.join(events, victims).sort_values(['crash_key', 'AGE']).reset_index(drop=True)
+    joined = pd.concat(buckets).sort_values(['crash_key', 'AGE']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(joined, expected)
+    assert joined.loc[joined['crash_record_id'] == 'c', 'AGE'].isna().all()
+
+def test_categorical_dimension_maps_missing_values_to_null():
+    # Rows of crashes without victims have category code -1, which takes the trailing None id
+    values = pd.Series(pd.Categorical(['RAIN', None, 'CLEAR', 'RAIN', 'FOG']), index=[10, 11, 12, 13, 14])
+    ids = transform.map_dimension(values, {'RAIN': 1, 'CLEAR': 2})
+    assert str(ids.dtype) == 'Int16'
+    assert list(ids.index) == [10, 11, 12, 13, 14]
+    assert ids.tolist() == [1, pd.NA, 2, 1, pd.NA]
+    pd.testing.assert_series_equal(ids, transform.map_dimension(values.astype(object), {'RAIN': 1, 'CLEAR': 2}))
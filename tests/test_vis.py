@@ -0,0 +1,61 @@
+import pytest
+
+vis = pytest.importorskip("vis")
+
+def relation(sql):
+    return sql.split(" FROM public.")[1].split(" ")[0]
+
+@pytest.mark.parametrize('grain, columns, filters, expected', [
+    # The rollup holds every crash level grouping column
+    ('crash', ['crash_hour'], [], 'agg_crash_rollup'),
+    ('crash', ['weather_condition', 'lighting_condition'], [('crash_hour', '=', 7)], 'agg_crash_rollup'),
+    # Filter columns missing from the rollup fall back to the crash view
+    ('crash', ['crash_hour'], [('crash_date', '=', '2024-01-01')], 'traffic_crashes_table'),
+    ('crash', ['beat_of_occurrence'], [], 'traffic_crashes_table'),
+    ('person', ['CELL_PHONE_USE'], [], 'agg_cell_phone_use'),
+    ('person', ['SEX', 'INJURY_CLASSIFICATION'], [('AGE', 'not_null', None)], 'agg_age_gender_injury'),
+    ('person', ['INJURY_CLASSIFICATION'], [('SAFETY_EQUIPMENT', 'in', ['USED'])], 'agg_safety_airbag_injury'),
+    ('person', ['DRIVER_ACTION'], [('prim_contributory_cause', '<>', 'UNABLE TO DETERMINE')],
+     'agg_cause_action_condition'),
+    # No summary table holds both, so the person view answers
+    ('person', ['CELL_PHONE_USE', 'SEX'], [], 'traffic_people_table'),
+    ('person', ['CELL_PHONE_USE'], [('weather_condition', '=', 'RAIN')], 'traffic_people_table'),
+])
+def test_smallest_relation_holding_the_columns(grain, columns, filters, expected):
+    sql, _ = vis.grain_query(grain, columns, 'cases', filters)
+    assert relation(sql) == expected
+
+def test_grain_is_respected():
+    # crash_hour is in the person view too, but a crash count never reads it
+    sql, _ = vis.grain_query('crash', ['crash_hour'], 'crashes')
+    assert relation(sql) == 'agg_crash_rollup'
+    sql, _ = vis.grain_query('person', ['crash_hour'], 'people')
+    assert relation(sql) == 'traffic_people_table'
+
+def test_unknown_columns():
+    with pytest.raises(ValueError):
+        vis.grain_query('crash', ['SEX'], 'crashes')
+    with pytest.raises(ValueError):
+        vis.grain_query('person', ['CELL_PHONE_USE'], 'cases', [('no_such_column', '=', 1)])
+
+def test_sql_without_filters():
+    sql, params = vis.grain_query('person', ['SEX', 'INJURY_CLASSIFICATION'], 'cases')
+    assert sql == ('SELECT "SEX", "INJURY_CLASSIFICATION", SUM(cases)::bigint AS cases FROM public.agg_age_gender_injury '
+                   'GROUP BY "SEX", "INJURY_CLASSIFICATION" ORDER BY "SEX", "INJURY_CLASSIFICATION"')
+    assert params == {}
+
+def test_filters_are_bound_parameters():
+    sql, params = vis.grain_query('crash', ['crash_hour'], 'crashes', [
+        ('weather_condition', 'in', ['RAIN', "SNOW'; DROP TABLE crashes; --"]),
+        ('lighting_condition', 'not_null', None),
+        ('prim_contributory_cause', '<>', 'UNABLE TO DETERMINE'),
+        ('crash_hour', '=', 7)
+    ])
+    assert sql == ('SELECT "crash_hour", SUM(num_crashes)::bigint AS crashes FROM public.agg_crash_rollup '
+                   'WHERE "weather_condition" = ANY(:filter_0) AND "lighting_condition" IS NOT NULL '
+                   'AND "prim_contributory_cause" <> :filter_2 AND "crash_hour" = :filter_3 '
+                   'GROUP BY "crash_hour" ORDER BY "crash_hour"')
+    # The values never reach the SQL text, not_null takes no parameter
+    assert "DROP TABLE" not in sql
+    assert params == {'filter_0': ['RAIN', "SNOW'; DROP TABLE crashes; --"], 'filter_2': 'UNABLE TO DETERMINE',
+                      'filter_3': 7}
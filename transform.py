@@ -1,15 +1,22 @@
+import io
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-from dagster import op, Out, In, get_dagster_logger
+from dagster import op, graph, Out, In, get_dagster_logger
 from dagster_pandas import PandasColumn, create_dagster_pandas_dataframe_type
-from pymongo import MongoClient, errors
+from pymongo import errors
 from sqlalchemy import create_engine, exc
-from sqlalchemy.pool import NullPool
-from sqlalchemy.types import *
-from datetime import datetime
+from sqlalchemy.engine.url import make_url
+from datetime import datetime, timedelta
 import psycopg2
 from sqlalchemy.sql import text
+from psycopg2.extras import execute_values
 import yaml
+from resources import get_mongo_client
+from cache import frame_cache, cache_key, code_version, cache_config, bump_load_generation, CacheEntryMissing
+from instrument import instrumented, instrumented_op, record
 
 logger = get_dagster_logger()
 
@@ -20,15 +27,34 @@ def load_config():
 config = load_config()
 # Connection string to the default database('postgres')
 default_admin_connection_string = config['connection']['default_admin_connection_string']
-# Connection string to the target database
-postgres_connection_string = config['connection']['postgres_connection_string']
-# Connection string to the mongodb
-mongo_connection_string = config['connection']['mongo_connection_string']
+# Number of documents fetched per round trip when reading from MongoDB
+cursor_batch_size = config['transform']['cursor_batch_size']
+# Crash events are stored with BSON dates and numbers, so they need no parsing on read
+typed_ingest = config['ingest']['typed']
+# Number of rows streamed per COPY round trip when loading PostgreSQL
+copy_chunk_size = config['load']['copy_chunk_size']
+# First crash date extracted from MongoDB
+extract_start_date = datetime.strptime(str(config['transform']['start_date']), '%Y-%m-%d')
+# Width of the date partitions read in parallel ('month' or 'week') and number of worker processes;
+# with a single worker the whole range is read with one query
+partition_width = config['transform']['partition_width']
+# (extraction runs inside transform_to_cache, which has no sibling ops, so the pool does not compete with other ops)
+extract_workers = config['transform']['extract_workers']
+# Number of hash buckets the crash -> victim join is split into; with more than one bucket the join
+# and the load run one bucket at a time
+join_partitions = config['transform']['join_partitions']
 
-def create_database(database_name):
+def admin_connection(engine):
+    # Admin connection of the server an engine points to: the configured one for the configured target database,
+    # the 'postgres' database of the engine's own server otherwise, e.g. the scratch server of a benchmark
+    if engine.url == make_url(config['connection']['postgres_connection_string']):
+        return default_admin_connection_string
+    return engine.url.set(database='postgres')
+
+def create_database(database_name, admin_connection_string=default_admin_connection_string):
     try:
         # Create an engine to the default database
-        engine = create_engine(default_admin_connection_string, isolation_level='AUTOCOMMIT')
+        engine = create_engine(admin_connection_string, isolation_level='AUTOCOMMIT')
 
         # Connect and create the database
         with engine.connect() as connection:
@@ -51,7 +77,8 @@ TraffCrashEventsDataFrame = create_dagster_pandas_dataframe_type(
         PandasColumn.string_column("prim_contributory_cause"),
         PandasColumn.string_column("location"),
         PandasColumn.float_column("latitude"),
-        PandasColumn.float_column("longitude")
+        PandasColumn.float_column("longitude"),
+        PandasColumn.integer_column("beat_of_occurrence")
     ]
 )
 
@@ -59,7 +86,7 @@ CrashVictimsDataFrame = create_dagster_pandas_dataframe_type(
     name="CrashVictimsDataFrame",
     columns=[
         PandasColumn.string_column("CRASH_RECORD_ID", non_nullable=True),
-        PandasColumn.float_column("AGE"),
+        PandasColumn.integer_column("AGE"),
         PandasColumn.string_column("SEX"),
         PandasColumn.string_column("INJURY_CLASSIFICATION"),
         PandasColumn.string_column("SAFETY_EQUIPMENT"),
@@ -70,11 +97,191 @@ CrashVictimsDataFrame = create_dagster_pandas_dataframe_type(
     ]
 )
 
-def transform_traffic_crash_events_data():
-    # Connect to the MongoDB database
-    client = MongoClient(mongo_connection_string)
-    db = client["TrafficIncidentsDB"]
+# Column types of the frames read from MongoDB, matching TraffCrashEventsDataFrame and CrashVictimsDataFrame
+TRAFF_CRASH_EVENTS_COLUMNS = {
+    'crash_record_id': 'string',
+    'crash_date': 'datetime',
+    'crash_hour': 'integer',
+    'weather_condition': 'string',
+    'lighting_condition': 'string',
+    'prim_contributory_cause': 'string',
+    'location': 'string',
+    'latitude': 'float',
+    'longitude': 'float',
+    'beat_of_occurrence': 'integer'
+}
+
+CRASH_VICTIMS_COLUMNS = {
+    'CRASH_RECORD_ID': 'string',
+    'AGE': 'float',
+    'SEX': 'string',
+    'INJURY_CLASSIFICATION': 'string',
+    'SAFETY_EQUIPMENT': 'string',
+    'AIRBAG_DEPLOYED': 'string',
+    'DRIVER_ACTION': 'string',
+    'PHYSICAL_CONDITION': 'string',
+    'CELL_PHONE_USE': 'string'
+}
+
+# Value used for missing data and compact dtype of every column after the transform; low cardinality
+# text becomes category, small integers int8/int16 and coordinates float32
+TRAFF_CRASH_EVENTS_FILL_VALUES = {
+    'crash_hour': -1,
+    'beat_of_occurrence': -1,
+    'weather_condition': 'No Data',
+    'lighting_condition': 'No Data',
+    'prim_contributory_cause': 'No Data',
+    'location': 'No Data',
+    'latitude': -1.0,
+    'longitude': -1.0
+}
+
+TRAFF_CRASH_EVENTS_DTYPES = {
+    'crash_hour': 'int8',
+    'beat_of_occurrence': 'int16',
+    'weather_condition': 'category',
+    'lighting_condition': 'category',
+    'prim_contributory_cause': 'category',
+    'latitude': 'float32',
+    'longitude': 'float32'
+}
+
+CRASH_VICTIMS_FILL_VALUES = {
+    'AGE': -1,
+    'SEX': 'No Data',
+    'INJURY_CLASSIFICATION': 'No Data',
+    'SAFETY_EQUIPMENT': 'No Data',
+    'AIRBAG_DEPLOYED': 'No Data',
+    'DRIVER_ACTION': 'No Data',
+    'PHYSICAL_CONDITION': 'No Data',
+    'CELL_PHONE_USE': 'No Data'
+}
+
+CRASH_VICTIMS_DTYPES = {
+    'AGE': 'int16',
+    'SEX': 'category',
+    'INJURY_CLASSIFICATION': 'category',
+    'SAFETY_EQUIPMENT': 'category',
+    'AIRBAG_DEPLOYED': 'category',
+    'DRIVER_ACTION': 'category',
+    'PHYSICAL_CONDITION': 'category',
+    'CELL_PHONE_USE': 'category'
+}
+
+def compact_frame(df, fill_values, dtypes, name):
+    # Normalize empty strings and missing values in one vectorized pass, then downcast every column
+    memory_before = df.memory_usage(deep=True).sum()
+    df = df.replace('', np.nan).fillna(fill_values)
+    for column, dtype in dtypes.items():
+        if dtype.startswith('int'):
+            df[column] = pd.to_numeric(df[column]).round()
+    df = df.astype(dtypes)
+    memory_after = df.memory_usage(deep=True).sum()
+    logger.info("{}: {} rows, memory {:.1f} MB -> {:.1f} MB".format(
+        name, len(df), memory_before / 1e6, memory_after / 1e6))
+    return df
+
+# dtypes of empty typed columns, which pandas would otherwise create as object
+EMPTY_COLUMN_DTYPES = {'datetime': 'datetime64[ns]', 'integer': 'float64', 'float': 'float64'}
+
+def read_collection_frame(collection, query, fields, column_types, batch_size=None, typed=False):
+    # Stream the cursor in batches and append every projected field straight into its own column list,
+    # instead of materializing a list of dicts and letting pandas pivot it
+    if batch_size is None:
+        batch_size = cursor_batch_size
+    names = [name for name, include in fields.items() if include]
+    columns = {name: [] for name in names}
+    appenders = [(name, columns[name].append) for name in names]
+
+    for document in collection.find(query, fields, batch_size=batch_size):
+        get = document.get
+        for name, append in appenders:
+            append(get(name))
+
+    # Decode each column once according to its type, typed documents already hold native values
+    frame = {}
+    for name in names:
+        column_type = column_types.get(name, 'string')
+        if typed and column_type != 'string':
+            values = columns.pop(name)
+            frame[name] = pd.Series(values, dtype=None if values else EMPTY_COLUMN_DTYPES[column_type])
+            continue
+        values = pd.Series(columns.pop(name), dtype=object)
+        if column_type == 'datetime':
+            values = pd.to_datetime(values, errors='coerce')
+        elif column_type in ('integer', 'float'):
+            values = pd.to_numeric(values, errors='coerce')
+        frame[name] = values
+    return pd.DataFrame(frame, columns=names)
+
+def date_query(field, start, end, as_string=False):
+    # Range filter on a date field, end is exclusive and None leaves the range open
+    if as_string:
+        start = start.strftime('%Y-%m-%dT%H:%M:%S')
+        end = end.strftime('%Y-%m-%dT%H:%M:%S') if end is not None else None
+    condition = {"$gte": start}
+    if end is not None:
+        condition["$lt"] = end
+    return {field: condition}
+
+def check_crash_date_type(collection):
+    # The crash_date range filter only matches dates of the configured type, so a collection ingested the other way
+    # would silently read nothing; the $type probe is answered from the crash_date index
+    unexpected = 'string' if typed_ingest else 'date'
+    if collection.find_one({'crash_date': {'$type': unexpected}}, {'_id': 1}) is not None:
+        if typed_ingest:
+            raise RuntimeError("traffic_crash_events still holds string crash dates while ingest.typed is true, "
+                               "run migrate_crash_events_job first")
+        raise RuntimeError("traffic_crash_events holds BSON crash dates while ingest.typed is false, "
+                           "set ingest.typed to true")
+
+def date_partitions(start, width, until=None):
+    # Split [start, until) into month or week windows; the last window is left open so nothing newer is missed
+    if until is None:
+        until = datetime.now()
+    partitions = []
+    while start < until:
+        if width == 'week':
+            end = start + timedelta(days=7)
+        else:
+            end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+        partitions.append((start, end))
+        start = end
+    if partitions:
+        partitions[-1] = (partitions[-1][0], None)
+    else:
+        partitions.append((start, None))
+    return partitions
+
+def concat_frames(frames, dtypes):
+    # Concatenate the frames of several partitions; categories differ between partitions, so the
+    # categorical columns are rebuilt on the combined frame. Empty partitions are left out, so they cannot
+    # turn a column into object, and when every partition is empty the first one keeps its compact dtypes
+    df = pd.concat([frame for frame in frames if len(frame)] or frames[:1], ignore_index=True)
+    return df.astype({column: dtype for column, dtype in dtypes.items() if dtype == 'category'})
+
+def extract_partition(transform_function, start, end):
+    # Runs in a worker process, which opens its own pooled MongoDB client
+    return transform_function(get_mongo_client(), start, end)
+
+def extract_in_partitions(transform_function, client, dtypes):
+    # Read and transform the date range with one query, or month/week partitions in a process pool
+    # so both the MongoDB cursors and the Python decoding run on several cores
+    if extract_workers <= 1:
+        return transform_function(client, extract_start_date)
+    partitions = date_partitions(extract_start_date, partition_width)
+    # spawn keeps the parent's MongoClient out of the worker processes
+    with ProcessPoolExecutor(max_workers=extract_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        frames = list(pool.map(extract_partition, [transform_function] * len(partitions),
+                               [start for start, _ in partitions], [end for _, end in partitions]))
+    return concat_frames(frames, dtypes)
+
+@instrumented
+def transform_traffic_crash_events_data(client, start=extract_start_date, end=None, database="TrafficIncidentsDB"):
+    # Use the shared MongoDB client
+    db = client[database]
     collection = db['traffic_crash_events']
+    check_crash_date_type(collection)
     # Specifying the fields to include in the results
     fields = {
         'crash_record_id' : 1,
@@ -86,40 +293,26 @@ def transform_traffic_crash_events_data():
         'location': 1,
         'latitude': 1,
         'longitude': 1,
+        'beat_of_occurrence': 1,
         '_id': 0  # Exclude MongoDB's default '_id' field unless needed
     }
     
-    non_char_cols = ['crash_hour', 'latitude', 'longitude']
-    col_names = ['weather_condition', 'lighting_condition', 'prim_contributory_cause', 'location']
-
-    #Execute the query with field projection
-    data = list(collection.find({"crash_date": {"$gte": "2024-01-01T00:00:00"}}, fields))
-    
-    traffic_crash_events_df = pd.DataFrame(data)
-    traffic_crash_events_df['crash_date'] = pd.to_datetime(traffic_crash_events_df['crash_date'], errors='coerce')
-    for col in non_char_cols:
-        traffic_crash_events_df[col] = pd.to_numeric(traffic_crash_events_df[col], errors='coerce')
+    #Execute the query with field projection, the range on crash_date is served by the (crash_date, crash_record_id) index
+    traffic_crash_events_df = read_collection_frame(
+        collection, date_query("crash_date", start, end, as_string=not typed_ingest), fields,
+        TRAFF_CRASH_EVENTS_COLUMNS, typed=typed_ingest
+    )
     
-    traffic_crash_events_df['crash_hour'] = traffic_crash_events_df['crash_hour'].replace('', np.nan)
-    traffic_crash_events_df['crash_hour'].fillna(-1, inplace=True)
-    for col_name in col_names:
-        traffic_crash_events_df[col_name] = traffic_crash_events_df[col_name].replace('', np.nan)
-        traffic_crash_events_df[col_name].fillna('No Data', inplace=True)
-    for col in ['latitude', 'longitude']:
-        traffic_crash_events_df[col] = traffic_crash_events_df[col].replace('', np.nan)
-        traffic_crash_events_df[col].fillna(-1.0, inplace=True)
-
-    traffic_crash_events_df['crash_hour'] = traffic_crash_events_df['crash_hour'].astype(int)
-    traffic_crash_events_df['latitude'] = traffic_crash_events_df['latitude'].astype(float)
-    traffic_crash_events_df['longitude'] = traffic_crash_events_df['longitude'].astype(float)
+    traffic_crash_events_df = compact_frame(
+        traffic_crash_events_df, TRAFF_CRASH_EVENTS_FILL_VALUES, TRAFF_CRASH_EVENTS_DTYPES, 'traffic_crash_events'
+    )
     # Return the data frame    
     return traffic_crash_events_df
 
-def transform_crash_victims_data():
-    # Connect to MongoDB using the specified URI
-    client = MongoClient(mongo_connection_string)
+@instrumented
+def transform_crash_victims_data(client, start=extract_start_date, end=None, database="TrafficIncidentsDB"):
     # Connect to the appropriate database and collection
-    db = client["TrafficIncidentsDB"]
+    db = client[database]
     collection = db['crash_victims']
     # Specify the fields to include in the results
     fields = {
@@ -135,100 +328,673 @@ def transform_crash_victims_data():
         '_id': 0  # Exclude MongoDB's default '_id' field unless needed
     }
 
-    col_names = ['SEX', 'INJURY_CLASSIFICATION', 'SAFETY_EQUIPMENT', 'AIRBAG_DEPLOYED', 'DRIVER_ACTION', 'PHYSICAL_CONDITION', 'CELL_PHONE_USE']
-
-    start_date_2024 = datetime(2024, 1, 1)
-
-    #Execute the query with field projection
-    data = list(collection.find({"CRASH_DATE": {"$gte": start_date_2024}}, fields))
-
-    crash_victims_df = pd.DataFrame(data)
-    crash_victims_df['AGE'] = pd.to_numeric(crash_victims_df['AGE'], errors='coerce')
-    crash_victims_df['AGE']= crash_victims_df['AGE'].replace('', np.nan)
-    crash_victims_df['AGE'].fillna(-1, inplace=True)
-
-    for col_name in col_names:
-        crash_victims_df[col_name] = crash_victims_df[col_name].replace('', np.nan)
-        crash_victims_df[col_name].fillna('No Data', inplace=True)
+    #Execute the query with field projection, the range on CRASH_DATE is served by the (CRASH_DATE, CRASH_RECORD_ID) index
+    crash_victims_df = read_collection_frame(
+        collection, date_query("CRASH_DATE", start, end), fields, CRASH_VICTIMS_COLUMNS
+    )
+    crash_victims_df = compact_frame(crash_victims_df, CRASH_VICTIMS_FILL_VALUES, CRASH_VICTIMS_DTYPES, 'crash_victims')
 
     # Return the transformed data frame
     return crash_victims_df
 
+def factorize_crash_keys(traffic_crash_events_df, crash_victims_df):
+    # Replace the 128 character crash record ids of both frames by shared integer codes, computed once;
+    # the codes also serve as the crash_id surrogate key of the crashes table
+    left_count = len(traffic_crash_events_df)
+    codes, _ = pd.factorize(pd.concat(
+        [traffic_crash_events_df['crash_record_id'], crash_victims_df['CRASH_RECORD_ID']], ignore_index=True))
+    codes = (codes + 1).astype('int32')
+    traffic_crash_events_df = traffic_crash_events_df.assign(crash_key=codes[:left_count])
+    # The CRASH_RECORD_ID column is dropped here, on the smaller frame, instead of after the merge
+    crash_victims_df = crash_victims_df.drop(columns=["CRASH_RECORD_ID"]).assign(crash_key=codes[left_count:])
+    return traffic_crash_events_df, crash_victims_df
+
+@instrumented
 def join(traffic_crash_events_df, crash_victims_df) -> pd.DataFrame:
-    # Join the two data frames    
+    # Join the two data frames on their integer crash keys
+    traffic_crash_events_df, crash_victims_df = factorize_crash_keys(traffic_crash_events_df, crash_victims_df)
     merged_df = traffic_crash_events_df.merge(
         right=crash_victims_df,
         how="left",
-        left_on="crash_record_id",
-        right_on="CRASH_RECORD_ID"
+        on="crash_key"
     )
     
-    # Drop the CRASH_RECORD_ID column as we already have a crash_record_id column
-    merged_df.drop(["CRASH_RECORD_ID"],axis=1,inplace=True)
-    
     # Return the joined data frames
     return merged_df
 
-def load(merged_df):
-    try:
-        # Try to create the database first; this will do nothing if the database already exists
-        db_name = config['connection']['database_name']
-        create_database(db_name)
-        # Create a connection to the PostgreSQL database
-        engine = create_engine(
-            postgres_connection_string,
-            poolclass=NullPool
-        )
-        # Create a dictionary with column names as the key and the VARCHAR type as the value.
-        #This will be used to specify data types for the created database. We will change some of these types later.
-        database_datatypes = dict(
-            zip(merged_df.columns,[VARCHAR]*len(merged_df.columns))
+def join_partitioned(traffic_crash_events_df, crash_victims_df, partitions):
+    # Hash both frames by crash key into buckets and yield the join of one bucket at a time, so only
+    # about 1/partitions of the joined rows are held in memory at once
+    traffic_crash_events_df, crash_victims_df = factorize_crash_keys(traffic_crash_events_df, crash_victims_df)
+    left_buckets = traffic_crash_events_df['crash_key'].to_numpy() % partitions
+    right_buckets = crash_victims_df['crash_key'].to_numpy() % partitions
+
+    for bucket in range(partitions):
+        yield traffic_crash_events_df[left_buckets == bucket].merge(
+            right=crash_victims_df[right_buckets == bucket],
+            how="left",
+            on="crash_key"
         )
-        
-        # Set date column to have the TIMESTAMP datatype
-        database_datatypes["crash_date"] = TIMESTAMP
-        
-        # Set columns with DOUBLE PRECISION datatype
-        for column in ["latitude","longitude","AGE"]:
-            database_datatypes[column] = DECIMAL
-        
-        # # Set columns with INT datatype
-        for column in ["crash_hour"]:
-            database_datatypes[column] = INT
-            
-        # Open the connection to the PostgreSQL server
-        with engine.connect() as conn:
-            rowcount = merged_df.to_sql(
-                name="traffic_incidents_table",
-                schema="public",
-                dtype=database_datatypes,
-                con=engine,
-                index=False,
-                if_exists="replace"
-            )
-            logger.info("{} records loaded".format(rowcount))
+
+def quote_identifier(name):
+    # Quote a column or table name for PostgreSQL, keeping upper case names such as "AGE"
+    return '"{}"'.format(name.replace('"', '""'))
+
+def copy_frame(cursor, table_name, df, chunk_size=None):
+    # Stream the data frame into the table with COPY ... FROM STDIN in CSV format, one chunk at a time,
+    # empty fields are loaded as NULL
+    if chunk_size is None:
+        chunk_size = copy_chunk_size
+    columns = ', '.join(quote_identifier(column) for column in df.columns)
+    copy_sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table_name, columns)
+    for start in range(0, len(df), chunk_size):
+        buffer = io.StringIO()
+        df.iloc[start:start + chunk_size].to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cursor.copy_expert(copy_sql, buffer)
+    return len(df)
+
+# Dimension tables of the star schema: (table, column of the merged frame, id column in the fact table)
+STAR_DIMENSIONS = [
+    ('dim_weather', 'weather_condition', 'weather_id'),
+    ('dim_lighting', 'lighting_condition', 'lighting_id'),
+    ('dim_cause', 'prim_contributory_cause', 'cause_id'),
+    ('dim_sex', 'SEX', 'sex_id'),
+    ('dim_injury', 'INJURY_CLASSIFICATION', 'injury_id'),
+    ('dim_safety_equipment', 'SAFETY_EQUIPMENT', 'safety_equipment_id'),
+    ('dim_airbag', 'AIRBAG_DEPLOYED', 'airbag_id'),
+    ('dim_driver_action', 'DRIVER_ACTION', 'driver_action_id'),
+    ('dim_physical_condition', 'PHYSICAL_CONDITION', 'physical_condition_id'),
+    ('dim_cell_phone_use', 'CELL_PHONE_USE', 'cell_phone_use_id')
+]
+
+# Crash level fact table, one row per crash_record_id; both fact tables are partitioned by month of
+# crash_date, so a single month can be reloaded on its own
+CRASHES_DDL = """
+    crash_id INTEGER NOT NULL,
+    crash_record_id VARCHAR(128) NOT NULL,
+    crash_date TIMESTAMP,
+    crash_hour SMALLINT,
+    weather_id SMALLINT,
+    lighting_id SMALLINT,
+    cause_id SMALLINT,
+    location VARCHAR,
+    latitude REAL,
+    longitude REAL,
+    beat_of_occurrence SMALLINT
+"""
+
+# Person level table, one row per victim of a crash
+PEOPLE_DDL = """
+    crash_id INTEGER NOT NULL,
+    crash_date TIMESTAMP,
+    age SMALLINT,
+    sex_id SMALLINT,
+    injury_id SMALLINT,
+    safety_equipment_id SMALLINT,
+    airbag_id SMALLINT,
+    driver_action_id SMALLINT,
+    physical_condition_id SMALLINT,
+    cell_phone_use_id SMALLINT
+"""
+
+# Unique key of the crashes table. A unique constraint of a partitioned table has to hold the partition key, so
+# crash_id is unique per crash_date; crash_date is never NULL (the extraction reads a crash_date range) and the ids
+# are unique overall by construction: one factorized code per crash in a full load, sequence ranges per partition load
+CRASH_ID_KEY = "UNIQUE (crash_id, crash_date)"
+
+# Indexes on the columns the visualizations filter and group by, as (name suffix, method and columns)
+STAR_INDEXES = {
+    'crashes': [
+        ('crash_record_id', 'btree (crash_record_id)'),
+        ('crash_date', 'brin (crash_date)'),
+        ('crash_hour', 'btree (crash_hour)'),
+        ('weather_lighting', 'btree (weather_id, lighting_id)'),
+        ('cause', 'btree (cause_id)')
+    ],
+    'people': [
+        ('crash_id', 'btree (crash_id)'),
+        ('sex_injury_age', 'btree (sex_id, injury_id, age)'),
+        ('safety_airbag_injury', 'btree (safety_equipment_id, airbag_id, injury_id)'),
+        ('driver_action_condition', 'btree (driver_action_id, physical_condition_id)'),
+        ('cell_phone_use', 'btree (cell_phone_use_id)')
+    ]
+}
+
+# Wide crash x victim select with the columns of the former traffic_incidents_table,
+# used for the view and for building the aggregates from the staging tables
+TRAFFIC_INCIDENTS_SELECT = """
+    SELECT c.crash_record_id, c.crash_date, c.crash_hour,
+           weather.name AS weather_condition, lighting.name AS lighting_condition,
+           cause.name AS prim_contributory_cause, c.location, c.latitude, c.longitude, c.beat_of_occurrence,
+           p.age AS "AGE", sex.name AS "SEX", injury.name AS "INJURY_CLASSIFICATION",
+           safety.name AS "SAFETY_EQUIPMENT", airbag.name AS "AIRBAG_DEPLOYED",
+           action.name AS "DRIVER_ACTION", cond.name AS "PHYSICAL_CONDITION", phone.name AS "CELL_PHONE_USE"
+    FROM {crashes} c
+    LEFT JOIN {people} p ON p.crash_id = c.crash_id
+    LEFT JOIN public.dim_weather weather ON weather.id = c.weather_id
+    LEFT JOIN public.dim_lighting lighting ON lighting.id = c.lighting_id
+    LEFT JOIN public.dim_cause cause ON cause.id = c.cause_id
+    LEFT JOIN public.dim_sex sex ON sex.id = p.sex_id
+    LEFT JOIN public.dim_injury injury ON injury.id = p.injury_id
+    LEFT JOIN public.dim_safety_equipment safety ON safety.id = p.safety_equipment_id
+    LEFT JOIN public.dim_airbag airbag ON airbag.id = p.airbag_id
+    LEFT JOIN public.dim_driver_action action ON action.id = p.driver_action_id
+    LEFT JOIN public.dim_physical_condition cond ON cond.id = p.physical_condition_id
+    LEFT JOIN public.dim_cell_phone_use phone ON phone.id = p.cell_phone_use_id
+"""
+
+# Crash grain select, one row per crash; crash level questions count these rows instead of the crash x victim rows,
+# which count a crash once per person involved
+CRASH_ROWS_SELECT = """
+    SELECT c.crash_id, c.crash_record_id, c.crash_date, c.crash_hour,
+           weather.name AS weather_condition, lighting.name AS lighting_condition,
+           cause.name AS prim_contributory_cause, c.location, c.latitude, c.longitude, c.beat_of_occurrence
+    FROM {crashes} c
+    LEFT JOIN public.dim_weather weather ON weather.id = c.weather_id
+    LEFT JOIN public.dim_lighting lighting ON lighting.id = c.lighting_id
+    LEFT JOIN public.dim_cause cause ON cause.id = c.cause_id
+"""
+
+# Person grain select, one row per person; unlike the crash x victim select it has no rows for crashes without people
+PERSON_ROWS_SELECT = """
+    SELECT c.crash_id, c.crash_date, c.crash_hour,
+           weather.name AS weather_condition, lighting.name AS lighting_condition,
+           cause.name AS prim_contributory_cause, c.latitude, c.longitude,
+           p.age AS "AGE", sex.name AS "SEX", injury.name AS "INJURY_CLASSIFICATION",
+           safety.name AS "SAFETY_EQUIPMENT", airbag.name AS "AIRBAG_DEPLOYED",
+           action.name AS "DRIVER_ACTION", cond.name AS "PHYSICAL_CONDITION", phone.name AS "CELL_PHONE_USE"
+    FROM {people} p
+    JOIN {crashes} c ON c.crash_id = p.crash_id
+    LEFT JOIN public.dim_weather weather ON weather.id = c.weather_id
+    LEFT JOIN public.dim_lighting lighting ON lighting.id = c.lighting_id
+    LEFT JOIN public.dim_cause cause ON cause.id = c.cause_id
+    LEFT JOIN public.dim_sex sex ON sex.id = p.sex_id
+    LEFT JOIN public.dim_injury injury ON injury.id = p.injury_id
+    LEFT JOIN public.dim_safety_equipment safety ON safety.id = p.safety_equipment_id
+    LEFT JOIN public.dim_airbag airbag ON airbag.id = p.airbag_id
+    LEFT JOIN public.dim_driver_action action ON action.id = p.driver_action_id
+    LEFT JOIN public.dim_physical_condition cond ON cond.id = p.physical_condition_id
+    LEFT JOIN public.dim_cell_phone_use phone ON phone.id = p.cell_phone_use_id
+"""
+
+# Views over the fact tables: the wide crash x victim view kept for ad hoc queries and one view per grain
+VIEWS = {
+    'traffic_incidents_table': TRAFFIC_INCIDENTS_SELECT,
+    'traffic_crashes_table': CRASH_ROWS_SELECT,
+    'traffic_people_table': PERSON_ROWS_SELECT
+}
+
+# Side of the square cells of the geographic grid, in degrees
+geo_grid_size = float(config['vis']['geo_grid_size'])
+
+# Crashes with a usable position; missing coordinates were filled with -1.0 and some reports carry 0, 0
+LOCATED_CRASHES = "latitude <> -1 AND longitude <> -1 AND NOT (latitude = 0 AND longitude = 0)"
+
+# Summary tables of earlier versions, dropped by the next full load
+RETIRED_AGGREGATES = ['agg_geo_points', 'agg_time_of_day', 'agg_weather_lighting']
+
+# Summary tables read by the visualizations, computed at the grain of their question: crash level tables from
+# the one row per crash in {crash_rows} or {crashes}, person level tables from the one row per person in {people_rows}.
+# They are not filtered, so vis.py can answer any question whose columns a table holds by summing its counts
+AGGREGATES = {
+    'agg_crash_rollup': """
+        SELECT COALESCE(crash_hour, -1) AS crash_hour, weather_condition, lighting_condition, prim_contributory_cause,
+               COUNT(*) AS num_crashes
+        FROM {crash_rows} t
+        GROUP BY COALESCE(crash_hour, -1), weather_condition, lighting_condition, prim_contributory_cause
+    """,
+    'agg_age_gender_injury': """
+        SELECT COALESCE("AGE", -1) AS "AGE", "SEX", "INJURY_CLASSIFICATION", COUNT(*) AS cases
+        FROM {people_rows} t
+        GROUP BY COALESCE("AGE", -1), "SEX", "INJURY_CLASSIFICATION"
+    """,
+    'agg_safety_airbag_injury': """
+        SELECT "SAFETY_EQUIPMENT", "AIRBAG_DEPLOYED", "INJURY_CLASSIFICATION", COUNT(*) AS cases
+        FROM {people_rows} t
+        GROUP BY "SAFETY_EQUIPMENT", "AIRBAG_DEPLOYED", "INJURY_CLASSIFICATION"
+    """,
+    'agg_cause_action_condition': """
+        SELECT prim_contributory_cause, "DRIVER_ACTION", "PHYSICAL_CONDITION", COUNT(*) AS num_cases
+        FROM {people_rows} t
+        GROUP BY prim_contributory_cause, "DRIVER_ACTION", "PHYSICAL_CONDITION"
+    """,
+    'agg_cell_phone_use': """
+        SELECT "CELL_PHONE_USE", COUNT(*) AS num_cases
+        FROM {people_rows} t
+        GROUP BY "CELL_PHONE_USE"
+    """,
+    'agg_geo_grid': """
+        SELECT (FLOOR(latitude / {grid}) + 0.5) * {grid} AS latitude,
+               (FLOOR(longitude / {grid}) + 0.5) * {grid} AS longitude,
+               COUNT(*) AS num_crashes
+        FROM {crashes} c
+        WHERE {located}
+        GROUP BY FLOOR(latitude / {grid}), FLOOR(longitude / {grid})
+    """,
+    'agg_geo_beats': """
+        SELECT beat_of_occurrence, AVG(latitude) AS latitude, AVG(longitude) AS longitude, COUNT(*) AS num_crashes
+        FROM {crashes} c
+        WHERE {located} AND beat_of_occurrence <> -1
+        GROUP BY beat_of_occurrence
+    """
+}
+
+def drop_relation(cursor, name):
+    # Drop a table or view of the public schema, whichever kind it currently is
+    cursor.execute(
+        "SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = 'public' AND c.relname = %s", (name,)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return
+    kinds = {'r': 'TABLE', 'p': 'TABLE', 'v': 'VIEW', 'm': 'MATERIALIZED VIEW'}
+    cursor.execute("DROP {} public.{}".format(kinds[row[0]], name))
+
+def create_indexes(cursor, table_name, indexes):
+    for suffix, definition in indexes:
+        cursor.execute("CREATE INDEX {0}_{1} ON public.{0} USING {2}".format(table_name, suffix, definition))
+
+def add_crash_id_key(cursor, table_name):
+    # Added after the COPY like the indexes; partitions attached later get their part of the key while attaching
+    cursor.execute("ALTER TABLE public.{0} ADD CONSTRAINT {0}_crash_id_key {1}".format(table_name, CRASH_ID_KEY))
+
+def list_partitions(cursor, table_name):
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class parent ON parent.oid = i.inhparent WHERE parent.relname = %s", (table_name,)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def swap_table(cursor, staging_table, table_name):
+    # Replace the table with the staging table; run inside the loading transaction so readers
+    # see either the old or the new table, never a half loaded one
+    drop_relation(cursor, table_name)
+    partitions = list_partitions(cursor, staging_table)
+    cursor.execute("ALTER TABLE public.{} RENAME TO {}".format(staging_table, table_name))
+    # Give the partitions and indexes of the staging table their final names, so the next load can reuse the staging names
+    tables = [table_name]
+    for partition in partitions:
+        if partition.startswith(staging_table):
+            tables.append(table_name + partition[len(staging_table):])
+            cursor.execute("ALTER TABLE public.{} RENAME TO {}".format(partition, tables[-1]))
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE schemaname = 'public' AND tablename = ANY(%s)", (tables,))
+    for (index_name,) in cursor.fetchall():
+        if index_name.startswith(staging_table):
+            cursor.execute("ALTER INDEX public.{} RENAME TO {}".format(
+                index_name, table_name + index_name[len(staging_table):]))
+
+def partition_name(table_name, start):
+    return "{}_p{:%Y%m}".format(table_name, start)
+
+def month_bounds(start, until=None):
+    # Month windows [start, end) from the month of start through the current month
+    start = datetime(start.year, start.month, 1)
+    bounds = date_partitions(start, 'month', until)
+    last_start = bounds[-1][0]
+    bounds[-1] = (last_start, datetime(last_start.year + last_start.month // 12, last_start.month % 12 + 1, 1))
+    return bounds
+
+def create_partitioned_table(cursor, table_name, ddl, bounds):
+    # Create a fact table partitioned by crash_date with one partition per month window and a default
+    # partition for crashes without a date or outside the windows
+    cursor.execute("CREATE TABLE public.{} ({}) PARTITION BY RANGE (crash_date)".format(table_name, ddl))
+    for start, end in bounds:
+        cursor.execute("CREATE TABLE public.{} PARTITION OF public.{} FOR VALUES FROM (%s) TO (%s)".format(
+            partition_name(table_name, start), table_name), (start, end))
+    cursor.execute("CREATE TABLE public.{0}_default PARTITION OF public.{0} DEFAULT".format(table_name))
+
+def sync_dimension(cursor, table_name, values):
+    # Add the values missing from a dimension table and return the name -> id mapping,
+    # ids stay stable between loads
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS public.{} (id SMALLINT PRIMARY KEY, name VARCHAR NOT NULL UNIQUE)".format(table_name))
+    cursor.execute("LOCK TABLE public.{} IN EXCLUSIVE MODE".format(table_name))
+    cursor.execute("SELECT name, id FROM public.{}".format(table_name))
+    mapping = dict(cursor.fetchall())
+
+    new_rows = []
+    next_id = max(mapping.values(), default=0) + 1
+    for value in values:
+        if value not in mapping:
+            mapping[value] = next_id
+            new_rows.append((next_id, value))
+            next_id += 1
+    if new_rows:
+        execute_values(cursor, "INSERT INTO public.{} (id, name) VALUES %s".format(table_name), new_rows)
+    return mapping
+
+def normalize(merged_df):
+    # Split the crash x victim frame into a crash level and a person level frame; the join key becomes the
+    # crash_id surrogate key and the low cardinality text columns stay as names until they are mapped to dimension ids
+    crash_ids = merged_df['crash_key']
+    victim_columns = [column for _, column, _ in STAR_DIMENSIONS if column in CRASH_VICTIMS_COLUMNS] + ['AGE']
+
+    crashes_df = merged_df[list(TRAFF_CRASH_EVENTS_COLUMNS)].assign(crash_id=crash_ids)
+    crashes_df = crashes_df.drop_duplicates('crash_record_id')
+
+    # Crashes without victims only come from the left join and have no person columns at all;
+    # people carry the crash_date of their crash as partition key
+    has_victim = merged_df[victim_columns].notna().any(axis=1)
+    people_df = merged_df.loc[has_victim, victim_columns + ['crash_date']].assign(crash_id=crash_ids[has_victim])
+    return crashes_df, people_df
+
+def map_dimension(values, mapping):
+    # Map names to dimension ids; a categorical column only maps its categories and reuses its codes
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        category_ids = pd.array([mapping.get(str(name)) for name in values.cat.categories] + [None], dtype='Int16')
+        return pd.Series(category_ids[values.cat.codes.to_numpy()], index=values.index)
+    return values.map(mapping).astype('Int16')
+
+def to_star_frame(df, dimension_ids, columns):
+    # Replace the dimension names by their ids and keep the columns of the target table in order
+    df = df.copy()
+    for column, id_column, mapping in dimension_ids:
+        if column in df.columns:
+            df[id_column] = map_dimension(df[column], mapping)
+    return df[columns]
+
+CRASH_COLUMNS = ['crash_id', 'crash_record_id', 'crash_date', 'crash_hour', 'weather_id', 'lighting_id',
+                 'cause_id', 'location', 'latitude', 'longitude', 'beat_of_occurrence']
+PEOPLE_COLUMNS = ['crash_id', 'crash_date', 'age', 'sex_id', 'injury_id', 'safety_equipment_id', 'airbag_id',
+                  'driver_action_id', 'physical_condition_id', 'cell_phone_use_id']
+
+# Sequence handing out crash_id ranges to partition loads
+CRASH_ID_SEQUENCE = 'crash_id_seq'
+
+def stage_frames(cursor, merged_frames, crashes_table, people_table, crash_id_offset=0):
+    # COPY the joined frames into the given crashes and people tables, mapping the text columns to dimension ids
+    crash_count, people_count = 0, 0
+    for merged_df in merged_frames:
+        crashes_df, people_df = normalize(merged_df)
+        del merged_df
+        # Native types for the fact tables
+        crashes_df['crash_id'] += crash_id_offset
+        people_df['crash_id'] += crash_id_offset
+        crashes_df['crash_hour'] = crashes_df['crash_hour'].astype('Int16')
+        crashes_df['beat_of_occurrence'] = crashes_df['beat_of_occurrence'].astype('Int16')
+        people_df = people_df.rename(columns={'AGE': 'age'})
+        people_df['age'] = people_df['age'].round().astype('Int16')
+
+        # New dimension values of this frame are added before its rows are copied
+        dimension_ids = []
+        for table_name, column, id_column in STAR_DIMENSIONS:
+            source = crashes_df if column in crashes_df.columns else people_df
+            values = [str(value) for value in pd.unique(source[column].dropna())]
+            dimension_ids.append((column, id_column, sync_dimension(cursor, table_name, values)))
+
+        crash_count += copy_frame(cursor, "public." + crashes_table, to_star_frame(crashes_df, dimension_ids, CRASH_COLUMNS))
+        people_count += copy_frame(cursor, "public." + people_table, to_star_frame(people_df, dimension_ids, PEOPLE_COLUMNS))
+    return crash_count, people_count
+
+def build_aggregates(cursor, crashes_table, people_table):
+    # Compute every summary table into a staging table from the given crashes and people tables
+    crashes, people = "public." + crashes_table, "public." + people_table
+    crash_rows = "({})".format(CRASH_ROWS_SELECT.format(crashes=crashes))
+    people_rows = "({})".format(PERSON_ROWS_SELECT.format(crashes=crashes, people=people))
+    for table_name, query in AGGREGATES.items():
+        cursor.execute("DROP TABLE IF EXISTS public.{}_staging".format(table_name))
+        cursor.execute("CREATE TABLE public.{}_staging AS {}".format(table_name, query.format(
+            crash_rows=crash_rows, people_rows=people_rows, crashes=crashes,
+            grid=geo_grid_size, located=LOCATED_CRASHES)))
+
+def swap_aggregates(cursor):
+    for table_name in AGGREGATES:
+        swap_table(cursor, table_name + "_staging", table_name)
+    for table_name in RETIRED_AGGREGATES:
+        drop_relation(cursor, table_name)
+
+def drop_views(cursor):
+    for view_name in VIEWS:
+        drop_relation(cursor, view_name)
+
+def create_views(cursor):
+    for view_name, select in VIEWS.items():
+        cursor.execute("CREATE VIEW public.{} AS {}".format(
+            view_name, select.format(crashes="public.crashes", people="public.people")))
+
+def reserve_crash_ids(cursor, count):
+    # Reserve count consecutive crash ids and return the offset to add to the 1-based ids of a load
+    cursor.execute("CREATE SEQUENCE IF NOT EXISTS public.{}".format(CRASH_ID_SEQUENCE))
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (CRASH_ID_SEQUENCE,))
+    cursor.execute("SELECT nextval(%s)", (CRASH_ID_SEQUENCE,))
+    offset = cursor.fetchone()[0] - 1
+    cursor.execute("SELECT setval(%s, %s)", (CRASH_ID_SEQUENCE, offset + max(count, 1)))
+    return offset
+
+def ensure_star_tables(cursor):
+    # Create empty partitioned fact tables, their indexes and the views when no full load has run yet
+    cursor.execute(
+        "SELECT relname, EXISTS (SELECT 1 FROM pg_partitioned_table p WHERE p.partrelid = c.oid) "
+        "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = 'public' AND c.relname IN ('crashes', 'people')"
+    )
+    tables = dict(cursor.fetchall())
+    if tables:
+        # Fact tables of earlier versions are plain tables, which cannot take a partition
+        if len(tables) < 2 or not all(tables.values()):
+            raise RuntimeError("public.crashes and public.people are not both partitioned by crash_date, "
+                               "run dagster_etl_pipeline for a full load first")
+        return
+    for table_name, ddl in [('crashes', CRASHES_DDL), ('people', PEOPLE_DDL)]:
+        create_partitioned_table(cursor, table_name, ddl, [])
+        create_indexes(cursor, table_name, STAR_INDEXES[table_name])
+    add_crash_id_key(cursor, 'crashes')
+    for table_name, _, _ in STAR_DIMENSIONS:
+        sync_dimension(cursor, table_name, [])
+    drop_views(cursor)
+    create_views(cursor)
+
+@instrumented
+def load(merged_frames, engine):
+    # merged_frames is the joined frame, or an iterable of joined buckets that are loaded one after the other
+    if isinstance(merged_frames, pd.DataFrame):
+        merged_frames = [merged_frames]
+    try:
+        # Try to create the database of the engine first, on the engine's server; this will do nothing if the
+        # database already exists
+        create_database(engine.url.database, admin_connection(engine))
+        started = time.monotonic()
+
+        # Load the star schema into staging tables with COPY and swap them in, all in one transaction,
+        # on a connection borrowed from the shared pool
+        conn = engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                bounds = month_bounds(extract_start_date)
+                for table_name, ddl in [('crashes', CRASHES_DDL), ('people', PEOPLE_DDL)]:
+                    drop_relation(cursor, table_name + "_staging")
+                    create_partitioned_table(cursor, table_name + "_staging", ddl, bounds)
+
+                crash_count, people_count = stage_frames(cursor, merged_frames, "crashes_staging", "people_staging")
+                if crash_count == 0:
+                    # Swapping empty staging tables in would wipe the fact and summary tables
+                    raise ValueError("No crashes to load, the current tables are kept")
+                rowcount = crash_count + people_count
+                record(rows_out=rowcount)
+
+                # Indexes are built once after the COPY, which is cheaper than maintaining them per row
+                for table_name in ['crashes', 'people']:
+                    create_indexes(cursor, table_name + "_staging", STAR_INDEXES[table_name])
+                add_crash_id_key(cursor, "crashes_staging")
+
+                # Rebuild every summary table from the staging data, so they are swapped in together with it
+                build_aggregates(cursor, "crashes_staging", "people_staging")
+
+                # The views depend on the fact tables, so they are dropped before and recreated after the swap
+                drop_views(cursor)
+                swap_table(cursor, "crashes_staging", "crashes")
+                swap_table(cursor, "people_staging", "people")
+                swap_aggregates(cursor)
+                create_views(cursor)
+                # Partition loads continue numbering after the crashes of the full load
+                cursor.execute("CREATE SEQUENCE IF NOT EXISTS public.{}".format(CRASH_ID_SEQUENCE))
+                cursor.execute("SELECT setval(%s, GREATEST((SELECT MAX(crash_id) FROM public.crashes), 1))",
+                               (CRASH_ID_SEQUENCE,))
+                cursor.execute("ANALYZE public.crashes")
+                cursor.execute("ANALYZE public.people")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        # Cached chart queries of the previous load are stale now
+        bump_load_generation()
+
+        elapsed = max(time.monotonic() - started, 1e-9)
+        logger.info("{} crashes and {} people loaded in {:.1f}s ({:.0f} rows/sec)".format(
+            crash_count, people_count, elapsed, rowcount / elapsed))
             
-        # Close the connection to PostgreSQL and dispose of the connection engine
-        engine.dispose(close=True)
-        
         logger.info("Data successfully loaded into PostgreSQL.")
         # Return the number of rows inserted
         return rowcount > 0
     
     # Trap and handle any relevant errors
-    except exc.SQLAlchemyError as error:
+    except (exc.SQLAlchemyError, psycopg2.Error) as error:
         logger.error("Error: %s" % error)
         return False
+
+@instrumented
+def load_partition(merged_df, engine, start, end):
+    # Replace the [start, end) month of the crashes and people tables: the month is loaded into standalone
+    # staging tables and swapped in with DETACH/ATTACH PARTITION, the other months are not touched.
+    # The summary tables are rebuilt in the same transaction, so the charts never see the new month half applied
+    started = time.monotonic()
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            ensure_star_tables(cursor)
+            offset = reserve_crash_ids(cursor, int(merged_df['crash_key'].max()) if len(merged_df) else 0)
+
+            for table_name in ['crashes', 'people']:
+                staging_table = partition_name(table_name, start) + "_staging"
+                drop_relation(cursor, staging_table)
+                cursor.execute("CREATE TABLE public.{} (LIKE public.{} INCLUDING DEFAULTS)".format(staging_table, table_name))
+                # A matching CHECK constraint lets ATTACH PARTITION skip scanning the new rows
+                cursor.execute(
+                    "ALTER TABLE public.{} ADD CONSTRAINT {}_range CHECK (crash_date IS NOT NULL AND crash_date >= %s AND crash_date < %s)".format(
+                        staging_table, staging_table), (start, end))
+            crash_count, people_count = stage_frames(
+                cursor, [merged_df], partition_name('crashes', start) + "_staging",
+                partition_name('people', start) + "_staging", crash_id_offset=offset)
+
+            for table_name in ['crashes', 'people']:
+                partition = partition_name(table_name, start)
+                if partition in list_partitions(cursor, table_name):
+                    cursor.execute("ALTER TABLE public.{} DETACH PARTITION public.{}".format(table_name, partition))
+                drop_relation(cursor, partition)
+                cursor.execute("ALTER TABLE public.{}_staging RENAME TO {}".format(partition, partition))
+                # The partitioned indexes of the parent are built on the new partition while attaching
+                cursor.execute("ALTER TABLE public.{} ATTACH PARTITION public.{} FOR VALUES FROM (%s) TO (%s)".format(
+                    table_name, partition), (start, end))
+                cursor.execute("ANALYZE public.{}".format(partition))
+            build_aggregates(cursor, "crashes", "people")
+            swap_aggregates(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    bump_load_generation()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    logger.info("{:%Y-%m}: {} crashes and {} people loaded in {:.1f}s".format(start, crash_count, people_count, elapsed))
+    return crash_count, people_count
+
+@instrumented
+def refresh_aggregates(engine):
+    # Recompute the summary tables from the live fact tables, e.g. after changing the geo grid size
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            build_aggregates(cursor, "crashes", "people")
+            swap_aggregates(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    bump_load_generation()
     
-@op(ins={"start1": In(bool), "start2": In(bool)}, out=Out(bool))
-def transform_and_load(start1: bool, start2: bool):
-    # Extract and transform traffic_crash_events data
-    traffic_crash_events_data = transform_traffic_crash_events_data()
-    # Extract and transform crash_victims data
-    crash_victims_data = transform_crash_victims_data()
-    # Load and join traffic_crash_events and crash_victims data
-    joined_data = join(traffic_crash_events_data, crash_victims_data) 
-
-    #loading the data into PostgreSQL
-    loaded_data = load(joined_data)
-    return loaded_data
\ No newline at end of file
+def source_fingerprint(client, start):
+    # Cheap summary of the source data of the extraction window: the document counts served by the date indexes
+    # and the change counters the ingests and the typed migration bump for every document they insert or modify,
+    # so in-place updates are seen in every ingest mode. Edits made outside the pipeline are not seen
+    db = client["TrafficIncidentsDB"]
+    check_crash_date_type(db['traffic_crash_events'])
+    events_query = date_query("crash_date", start, None, as_string=not typed_ingest)
+    changes = {state['_id']: state.get('changes', 0) for state in db['ingest_state'].find({}, {'changes': 1})}
+    return {
+        'start': start,
+        'crash_events': db['traffic_crash_events'].count_documents(events_query),
+        'crash_events_changes': changes.get('traffic_crash_events', 0),
+        'crash_victims': db['crash_victims'].count_documents(date_query("CRASH_DATE", start, None)),
+        'crash_victims_changes': changes.get('crash_victims', 0)
+    }
+
+# Versions of the code producing the cached frames
+TRANSFORM_VERSION = code_version(
+    read_collection_frame, compact_frame, transform_traffic_crash_events_data, transform_crash_victims_data,
+    TRAFF_CRASH_EVENTS_FILL_VALUES, TRAFF_CRASH_EVENTS_DTYPES, CRASH_VICTIMS_FILL_VALUES, CRASH_VICTIMS_DTYPES
+)
+JOIN_VERSION = code_version(factorize_crash_keys, join, join_partitioned)
+
+def read_cached_frame(name, key):
+    # The frame of a single frame cache entry, or None when it is missing or evicted while it is read
+    try:
+        return next(frame_cache.read(name, key))
+    except (CacheEntryMissing, FileNotFoundError, StopIteration):
+        return None
+
+@op(ins={"start1": In(bool), "start2": In(bool)}, out=Out(str), required_resource_keys={"mongo"})
+@instrumented_op
+def transform_to_cache(context, start1: bool, start2: bool) -> str:
+    # Extract, transform and join into the local Parquet cache and return the key of the joined frames;
+    # a rerun over unchanged source data finds the entries and skips MongoDB entirely
+    client = context.resources.mongo
+    clean_key = cache_key(source_fingerprint(client, extract_start_date), TRANSFORM_VERSION)
+    joined_key = cache_key(clean_key, JOIN_VERSION, join_partitions)
+    if cache_config['reuse'] and frame_cache.get('joined', joined_key) is not None:
+        logger.info("Joined frames found in the cache ({}).".format(joined_key))
+        return joined_key
+
+    traffic_crash_events_data, crash_victims_data = None, None
+    if cache_config['reuse']:
+        traffic_crash_events_data = read_cached_frame('crash_events', clean_key)
+        if traffic_crash_events_data is not None:
+            crash_victims_data = read_cached_frame('crash_victims', clean_key)
+    if traffic_crash_events_data is not None and crash_victims_data is not None:
+        logger.info("Transformed frames found in the cache ({}).".format(clean_key))
+    else:
+        # Extract and transform traffic_crash_events data
+        traffic_crash_events_data = extract_in_partitions(
+            transform_traffic_crash_events_data, client, TRAFF_CRASH_EVENTS_DTYPES)
+        # Extract and transform crash_victims data
+        crash_victims_data = extract_in_partitions(
+            transform_crash_victims_data, client, CRASH_VICTIMS_DTYPES)
+        frame_cache.put('crash_events', clean_key, [traffic_crash_events_data])
+        frame_cache.put('crash_victims', clean_key, [crash_victims_data], keep=[('crash_events', clean_key)])
+
+    # Join traffic_crash_events and crash_victims data, bucket by bucket when partitioned
+    if join_partitions > 1:
+        joined_data = join_partitioned(traffic_crash_events_data, crash_victims_data, join_partitions)
+    else:
+        joined_data = [join(traffic_crash_events_data, crash_victims_data)]
+    frame_cache.put('joined', joined_key, joined_data, keep=[('crash_events', clean_key), ('crash_victims', clean_key)])
+    return joined_key
+
+@op(ins={"joined_key": In(str)}, out=Out(bool), required_resource_keys={"postgres"})
+@instrumented_op
+def load_from_cache(context, joined_key: str) -> bool:
+    # Load the cached joined frames one file at a time into PostgreSQL. An evicted entry raises CacheEntryMissing
+    # and a file evicted while loading raises FileNotFoundError, both roll the load back; rerun transform_to_cache
+    return load(frame_cache.read('joined', joined_key), context.resources.postgres)
+
+@graph
+def transform_and_load(start1, start2):
+    # Split in two ops, so a failed load is retried from the cache instead of from MongoDB
+    return load_from_cache(transform_to_cache(start1, start2))
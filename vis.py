@@ -1,11 +1,15 @@
+import os
+import json
 import pandas.io.sql as sqlio
 import psycopg2
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
-from dagster import op, In
-from bokeh.plotting import figure, show, output_file
-from sqlalchemy import create_engine, event, text, exc
+from dagster import op, AssetMaterialization, MetadataValue
+from bokeh.plotting import figure, show, output_file, save
+from bokeh.embed import json_item
+from bokeh.resources import CDN
+from sqlalchemy import event, text, exc
 from sqlalchemy.engine.url import URL
 from bokeh.models import ColumnDataSource, FactorRange
 from bokeh.transform import factor_cmap
@@ -14,6 +18,9 @@ from bokeh.layouts import gridplot
 import plotly.express as px
 import yaml
 import plotly.graph_objects as go
+from instrument import instrumented_op, measure, record
+from cache import query_cache
+from transform import quote_identifier
 
 
 def load_config():
@@ -21,64 +28,140 @@ def load_config():
         return yaml.safe_load(file)
 
 config = load_config()
-
-# Connection string to PostgreSQL database
-postgres_connection_string = config['connection']['postgres_connection_string']
-
-@op(
-    ins={"start": In(bool)}
-)
-
-@op
-def visualize_time_of_day_impact(start: bool):
-    query_string = """
-    SELECT COALESCE(crash_hour, -1) AS crash_hour, COUNT(*) AS num_crashes
-    FROM traffic_incidents_table
-    GROUP BY COALESCE(crash_hour, -1)
-    ORDER BY COALESCE(crash_hour, -1);
-    """
-    engine = create_engine(postgres_connection_string)
-    try:
-        with engine.connect() as connection:
-            df = sqlio.read_sql_query(query_string, connection)
-
-        fig = px.bar(df, x='crash_hour', y='num_crashes', title='Impact of Time of Day on Crash Outcomes', 
-                     labels={'crash_hour': 'Hour of the Day', 'num_crashes': 'Number of Crashes'})
-        fig.show()
-
-    finally:
-        engine.dispose()
-
-
-@op
-def visualize_age_gender_impact(start: bool):
+# 'files' writes every chart to output_dir for headless workers, 'show' opens them in a browser
+render_mode = config['vis']['render_mode']
+output_dir = config['vis']['output_dir']
+# Formats written in 'files' mode: html, json and png (png needs kaleido for plotly and selenium for bokeh)
+output_formats = config['vis']['formats']
+# Geographic binning of the crashes: 'grid' (square cells of geo_grid_size degrees) or 'beat' (police beats)
+geo_mode = config['vis']['geo_mode']
+
+# Relations the research questions are answered from, smallest first, as (relation, grain, columns, count).
+# Crash level questions count crashes and person level questions count people, so a crash with several
+# people involved is counted once in the crash level charts
+CRASH_COLUMNS = ['crash_hour', 'weather_condition', 'lighting_condition', 'prim_contributory_cause']
+PERSON_COLUMNS = ['AGE', 'SEX', 'INJURY_CLASSIFICATION', 'SAFETY_EQUIPMENT', 'AIRBAG_DEPLOYED', 'DRIVER_ACTION',
+                  'PHYSICAL_CONDITION', 'CELL_PHONE_USE']
+CHART_SOURCES = [
+    ('agg_crash_rollup', 'crash', CRASH_COLUMNS, 'SUM(num_crashes)'),
+    ('traffic_crashes_table', 'crash', CRASH_COLUMNS + ['crash_date', 'beat_of_occurrence'], 'COUNT(*)'),
+    ('agg_cell_phone_use', 'person', ['CELL_PHONE_USE'], 'SUM(num_cases)'),
+    ('agg_safety_airbag_injury', 'person', ['SAFETY_EQUIPMENT', 'AIRBAG_DEPLOYED', 'INJURY_CLASSIFICATION'], 'SUM(cases)'),
+    ('agg_age_gender_injury', 'person', ['AGE', 'SEX', 'INJURY_CLASSIFICATION'], 'SUM(cases)'),
+    ('agg_cause_action_condition', 'person', ['prim_contributory_cause', 'DRIVER_ACTION', 'PHYSICAL_CONDITION'], 'SUM(num_cases)'),
+    ('traffic_people_table', 'person', CRASH_COLUMNS + ['crash_date'] + PERSON_COLUMNS, 'COUNT(*)')
+]
+
+# Conditions of the chart filters, the values are passed as bound parameters
+FILTER_OPERATORS = {
+    'not_null': "{column} IS NOT NULL",
+    'in': "{column} = ANY(:{param})",
+    '=': "{column} = :{param}",
+    '<>': "{column} <> :{param}"
+}
+
+def grain_query(grain, columns, count_name, filters=()):
+    # Count crashes or people by the given columns, from the smallest relation of that grain holding all of them
+    # and the filter columns; filters are (column, operator, value) and the result is (sql, params)
+    filter_columns = [column for column, _, _ in filters]
+    for relation, source_grain, source_columns, count in CHART_SOURCES:
+        if source_grain == grain and set(columns + filter_columns) <= set(source_columns):
+            break
+    else:
+        raise ValueError("No {} level relation holds {}".format(grain, columns + filter_columns))
+    conditions, params = [], {}
+    for number, (column, operator, value) in enumerate(filters):
+        param = "filter_{}".format(number)
+        conditions.append(FILTER_OPERATORS[operator].format(column=quote_identifier(column), param=param))
+        if operator != 'not_null':
+            params[param] = value
+    column_list = ', '.join(quote_identifier(column) for column in columns)
+    sql = "SELECT {0}, {1}::bigint AS {2} FROM public.{3}{4} GROUP BY {0} ORDER BY {0}".format(
+        column_list, count, count_name, relation, " WHERE " + " AND ".join(conditions) if conditions else "")
+    return sql, params
+
+def read_query(engine, query_string, params=None):
+    # Chart queries are answered from the query cache until the next load, the query is measured apart from the render
+    with measure('query') as query_stage:
+        df, hit = query_cache.read(engine, query_string, params)
+        query_stage.rows_out = len(df)
+        record(cache_hits=int(hit), cache_misses=int(not hit))
+    return df
+
+def render(context, fig, name):
+    # Rendering is measured apart from the query of the op
+    with measure('render_' + name):
+        write_chart(context, fig, name)
+
+def write_chart(context, fig, name):
+    # Show the chart, or write it to output_dir and record the files as an asset materialization
+    is_plotly = isinstance(fig, go.Figure)
+    if render_mode == 'show':
+        if is_plotly:
+            fig.show()
+        else:
+            output_file(os.path.join(output_dir, name + '.html'))
+            show(fig)
+        return
+
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {}
+    for fmt in output_formats:
+        path = os.path.join(output_dir, "{}.{}".format(name, fmt))
+        if fmt == 'html':
+            if is_plotly:
+                fig.write_html(path, include_plotlyjs='cdn')
+            else:
+                save(fig, filename=path, resources=CDN, title=name)
+        elif fmt == 'json':
+            if is_plotly:
+                fig.write_json(path)
+            else:
+                with open(path, 'w') as file:
+                    json.dump(json_item(fig), file)
+        elif fmt == 'png':
+            if is_plotly:
+                fig.write_image(path)
+            else:
+                from bokeh.io import export_png
+                export_png(fig, filename=path)
+        else:
+            raise ValueError("Unsupported chart format: {}".format(fmt))
+        paths[fmt] = MetadataValue.path(os.path.abspath(path))
+
+    context.log_event(AssetMaterialization(asset_key="chart_" + name, metadata=paths))
+
+@op(required_resource_keys={"postgres"})
+@instrumented_op
+def visualize_time_of_day_impact(context, start: bool):
+    query_string, params = grain_query('crash', ['crash_hour'], 'num_crashes')
+    # Shared, pooled engine of the run
+    engine = context.resources.postgres
+    df = read_query(engine, query_string, params)
+
+    fig = px.bar(df, x='crash_hour', y='num_crashes', title='Impact of Time of Day on Crash Outcomes', 
+                 labels={'crash_hour': 'Hour of the Day', 'num_crashes': 'Number of Crashes'})
+    render(context, fig, 'time_of_day_impact')
+
+
+@op(required_resource_keys={"postgres"})
+@instrumented_op
+def visualize_age_gender_impact(context, start: bool):
     # SQL query to fetch data
-    query_string = """
-    SELECT COALESCE("AGE", -1) AS "AGE", "SEX", "INJURY_CLASSIFICATION", COUNT(*) as cases
-    FROM traffic_incidents_table
-    WHERE "INJURY_CLASSIFICATION" IS NOT NULL 
-    AND "SEX" IN ('M', 'F')
-    AND "AGE" != -1
-    GROUP BY COALESCE("AGE", -1), "SEX", "INJURY_CLASSIFICATION"
-    ORDER BY COALESCE("AGE", -1), "SEX";
-    """
-    engine = create_engine(postgres_connection_string)
-    try:
-        with engine.connect() as connection:
-            df = pd.read_sql(query_string, connection)
-    
-        df['AGE'] = df['AGE'].astype(str)
-        output_file("age_gender_impact.html")
+    query_string, params = grain_query('person', ['AGE', 'SEX', 'INJURY_CLASSIFICATION'], 'cases', filters=[
+        ('INJURY_CLASSIFICATION', 'not_null', None), ('SEX', 'in', ['M', 'F']), ('AGE', '<>', -1)])
+    engine = context.resources.postgres
+    df = read_query(engine, query_string, params)
+
+    df['AGE'] = df['AGE'].astype(str)
 
-        # Filter DataFrame for 'M' and 'F' genders
-        df_m = df[(df['SEX'] == 'M')]
-        df_f = df[(df['SEX'] == 'F')]
+    # Filter DataFrame for 'M' and 'F' genders
+    df_m = df[(df['SEX'] == 'M')]
+    df_f = df[(df['SEX'] == 'F')]
 
-        # Create separate plots for each gender
-        create_plot(df_m, 'M', 'blue')
-        create_plot(df_f, 'F', 'pink')
-    finally:
-        engine.dispose()
+    # Create separate plots for each gender
+    render(context, create_plot(df_m, 'M', 'blue'), 'age_gender_impact_m')
+    render(context, create_plot(df_f, 'F', 'pink'), 'age_gender_impact_f')
 
 def create_plot(df_gender, gender, color):
     # Create a new plot with a title and axis labels
@@ -109,121 +192,98 @@ def create_plot(df_gender, gender, color):
     p.background_fill_color = "beige"
     p.background_fill_alpha = 0.5
  
-    show(p)
-
-@op
-def visualize_safety_measures_effectiveness(start: bool):
-    query_string = """
-    SELECT "SAFETY_EQUIPMENT", "AIRBAG_DEPLOYED", "INJURY_CLASSIFICATION", COUNT(*) as cases
-    FROM traffic_incidents_table
-    WHERE "INJURY_CLASSIFICATION" IS NOT NULL
-    GROUP BY "SAFETY_EQUIPMENT", "AIRBAG_DEPLOYED", "INJURY_CLASSIFICATION"
-    ORDER BY "SAFETY_EQUIPMENT", "AIRBAG_DEPLOYED";
-    """
-    engine = create_engine(postgres_connection_string)
-    with engine.connect() as connection:
-        df = sqlio.read_sql_query(query_string, connection)
+    return p
+
+@op(required_resource_keys={"postgres"})
+@instrumented_op
+def visualize_safety_measures_effectiveness(context, start: bool):
+    query_string, params = grain_query('person', ['SAFETY_EQUIPMENT', 'AIRBAG_DEPLOYED', 'INJURY_CLASSIFICATION'], 'cases',
+                                       filters=[('INJURY_CLASSIFICATION', 'not_null', None)])
+    engine = context.resources.postgres
+    df = read_query(engine, query_string, params)
 
     # Plotting using Plotly
     fig = px.bar(df, x='SAFETY_EQUIPMENT', y='cases', color='AIRBAG_DEPLOYED',
                  title='Effectiveness of Safety Measures on Injury Severity',
                  labels={'SAFETY_EQUIPMENT': 'Safety Equipment', 'cases': 'Cases', 'AIRBAG_DEPLOYED': 'Airbag Deployed'})
-    fig.show()
-    engine.dispose()
-
-@op
-def visualize_environmental_impact(start: bool):
-    query_string = """
-    SELECT weather_condition, lighting_condition, COUNT(*) AS num_crashes
-    FROM traffic_incidents_table
-    GROUP BY weather_condition, lighting_condition
-    ORDER BY weather_condition, lighting_condition;
-    """
-    engine = create_engine(postgres_connection_string)
-    try:
-        with engine.connect() as connection:
-            df = sqlio.read_sql_query(query_string, connection)
-
-        fig = px.bar(df, x='weather_condition', y='num_crashes', color='lighting_condition', 
-                     title='Impact of Weather and Lighting Conditions on Crash Frequency', 
-                     labels={'weather_condition': 'Weather Condition', 'num_crashes': 'Number of Crashes', 
-                             'lighting_condition': 'Lighting Condition'})
-        fig.show()
-
-    finally:
-        engine.dispose()
-
-@op
-def visualize_crash_causes(start: bool):
-    engine = create_engine(postgres_connection_string)
-    try:
-        query = """
-        SELECT prim_contributory_cause, "DRIVER_ACTION", "PHYSICAL_CONDITION", COUNT(*) AS num_cases
-        FROM traffic_incidents_table
-        GROUP BY prim_contributory_cause, "DRIVER_ACTION", "PHYSICAL_CONDITION"
-        ORDER BY prim_contributory_cause, "DRIVER_ACTION", "PHYSICAL_CONDITION";
+    render(context, fig, 'safety_measures_effectiveness')
+
+@op(required_resource_keys={"postgres"})
+@instrumented_op
+def visualize_environmental_impact(context, start: bool):
+    query_string, params = grain_query('crash', ['weather_condition', 'lighting_condition'], 'num_crashes')
+    engine = context.resources.postgres
+    df = read_query(engine, query_string, params)
+
+    fig = px.bar(df, x='weather_condition', y='num_crashes', color='lighting_condition', 
+                 title='Impact of Weather and Lighting Conditions on Crash Frequency', 
+                 labels={'weather_condition': 'Weather Condition', 'num_crashes': 'Number of Crashes', 
+                         'lighting_condition': 'Lighting Condition'})
+    render(context, fig, 'environmental_impact')
+
+
+@op(required_resource_keys={"postgres"})
+@instrumented_op
+def visualize_crash_causes(context, start: bool):
+    engine = context.resources.postgres
+    # The causes are counted per crash, the driver actions and physical conditions per person
+    causes = read_query(engine, *grain_query('crash', ['prim_contributory_cause'], 'num_crashes'))
+    cause_counts = causes.set_index('prim_contributory_cause')['num_crashes'].sort_values(ascending=False)
+    df = read_query(engine, *grain_query('person', ['DRIVER_ACTION', 'PHYSICAL_CONDITION'], 'num_cases'))
+
+    fig1 = px.bar(y=cause_counts.index, x=cause_counts.values, orientation='h', 
+                  title='Frequency of Primary Contributory Causes', 
+                  labels={'x': 'Number of Crashes', 'y': 'Primary Contributory Cause'})
+
+    pivot_table = df.pivot_table(index='DRIVER_ACTION', columns='PHYSICAL_CONDITION', 
+                                 values='num_cases', aggfunc='sum', fill_value=0)
+    fig2 = go.Figure(data=go.Heatmap(z=pivot_table.values, x=pivot_table.columns, y=pivot_table.index, 
+                                      colorscale='viridis'))
+    fig2.update_layout(title='Driver Actions and Physical Conditions by Primary Cause', 
+                       xaxis_title='Physical Condition', yaxis_title='Driver Action')
+
+    render(context, fig1, 'crash_causes')
+    render(context, fig2, 'driver_action_physical_condition')
+
+
+@op(required_resource_keys={"postgres"})
+@instrumented_op
+def visualize_cell_phone_impact(context, start: bool):
+    engine = context.resources.postgres
+    df = read_query(engine, *grain_query('person', ['CELL_PHONE_USE'], 'num_cases'))
+    df['CELL_PHONE_USE'] = df['CELL_PHONE_USE'].fillna('Unknown')
+
+    fig = px.bar(df, x='CELL_PHONE_USE', y='num_cases', 
+                 title='Impact of Cell Phone Use on Crash Involvement', 
+                 labels={'CELL_PHONE_USE': 'Cell Phone Use', 'num_cases': 'Number of Cases'})
+    render(context, fig, 'cell_phone_impact')
+
+
+@op(required_resource_keys={"postgres"})
+@instrumented_op
+def visualize_geographic_patterns(context, start: bool):
+    # Crash counts binned server-side into grid cells or police beats, one row per crash and without
+    # the placeholder coordinates, so the plot stays small on the full history
+    if geo_mode == 'beat':
+        query_string = """
+        SELECT beat_of_occurrence, latitude, longitude, num_crashes
+        FROM agg_geo_beats;
         """
-        with engine.connect() as connection:
-            df = pd.read_sql_query(query, engine)                
-            cause_counts = df['prim_contributory_cause'].value_counts()
-
-        fig1 = px.bar(y=cause_counts.index, x=cause_counts.values, orientation='h', 
-                      title='Frequency of Primary Contributory Causes', 
-                      labels={'x': 'Number of Cases', 'y': 'Primary Contributory Cause'})
-
-        pivot_table = df.pivot_table(index='DRIVER_ACTION', columns='PHYSICAL_CONDITION', 
-                                     values='num_cases', aggfunc='sum', fill_value=0)
-        fig2 = go.Figure(data=go.Heatmap(z=pivot_table.values, x=pivot_table.columns, y=pivot_table.index, 
-                                          colorscale='viridis'))
-        fig2.update_layout(title='Driver Actions and Physical Conditions by Primary Cause', 
-                           xaxis_title='Physical Condition', yaxis_title='Driver Action')
-
-        fig1.show()
-        fig2.show()
-
-    finally:
-       engine.dispose()
-
-@op
-def visualize_cell_phone_impact(start: bool):
-    engine = create_engine(postgres_connection_string)
-    try:
-        query = """
-        SELECT "CELL_PHONE_USE", COUNT(*) AS num_cases
-        FROM traffic_incidents_table
-        GROUP BY "CELL_PHONE_USE"
-        ORDER BY "CELL_PHONE_USE";
+        hover_name = 'beat_of_occurrence'
+    else:
+        query_string = """
+        SELECT latitude, longitude, num_crashes
+        FROM agg_geo_grid;
         """
-        df = pd.read_sql_query(query, engine)
-        df['CELL_PHONE_USE'] = df['CELL_PHONE_USE'].fillna('Unknown')
-
-        fig = px.bar(df, x='CELL_PHONE_USE', y='num_cases', 
-                     title='Impact of Cell Phone Use on Crash Involvement', 
-                     labels={'CELL_PHONE_USE': 'Cell Phone Use', 'num_cases': 'Number of Cases'})
-        fig.show()
-
-    finally:
-        engine.dispose()
-
-@op
-def visualize_geographic_patterns(start: bool):
-    query_string = """
-    SELECT latitude, longitude, location
-    FROM traffic_incidents_table;
-    """
-    engine = create_engine(postgres_connection_string)
-    try:
-        with engine.connect() as connection:
-            df = pd.read_sql_query(query_string, connection)
-        
-        if df.empty:
-            print("No data found.")
-            return
-
-        fig = px.scatter_geo(df, lat='latitude', lon='longitude', hover_name='location', 
-                             title='Geographic Patterns of Traffic Incidents', 
-                             projection='natural earth')
-        fig.show()
-
-    finally:
-        engine.dispose()
\ No newline at end of file
+        hover_name = None
+    engine = context.resources.postgres
+    df = read_query(engine, query_string)
+    
+    if df.empty:
+        context.log.warning("No data found for the geographic patterns chart.")
+        return
+
+    fig = px.scatter_geo(df, lat='latitude', lon='longitude', size='num_crashes', hover_name=hover_name,
+                         hover_data=['num_crashes'], title='Geographic Patterns of Traffic Incidents', 
+                         projection='natural earth', fitbounds='locations')
+    render(context, fig, 'geographic_patterns')
\ No newline at end of file